@@ -1,143 +1,69 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import sys
 import flask
 from flask import Flask, render_template, request, send_file
-import pandas as pd
 import shutil
-from smart_ingestion import SmartIngestor
+import tempfile
+import threading
+from zip_stream import iter_zip_dir
+from progress import FINAL_STATUSES, read_completed, read_progress, read_results
+from output_profiles import get_profile, is_raster
+from logs import get_logger, setup_logging
+from metrics import (HTTP_REQUEST_SECONDS, HTTP_REQUESTS, REGISTRY, RENDER_METRICS, STARTUP_SECONDS,
+                     VALIDATIONS, get_run_profiler, memory_summary, sample_process_memory)
+from run_store import has_run, load_records, open_photo_blob, write_run
 import uuid
-import qrcode
 import base64
-import cairosvg
 import os
-import re
-import requests
-import zipfile
-from io import BytesIO
-from PIL import Image
-import time
+import json
+import contextlib
+
+# Heavy modules are imported by the routes that use them: pandas (smart_ingestion),
+# cairosvg/cairocffi (render_engine, pdf_export) and the render pool (render_service).
+# Under gunicorn, preload_assets() imports them once in the master instead.
 
 app = Flask(__name__)
+# No logging setup on import: under gunicorn the hooks configure it (the master
+# must not start the listener thread before forking), ``python app.py`` below
+if __name__ == "__main__":
+    setup_logging()
+log = get_logger('app')
 
-# Upgraded Professional SVG Template
+TEMPLATE_PATH = os.path.join(app.root_path, 'templates', 'certificate_template.svg')
+SIGNATURE_PATH = os.path.join(app.root_path, 'signature.png')
 
 def load_svg_template():
-    """Load the SVG template from the file."""
-    template_path = os.path.join(app.root_path, 'templates', 'certificate_template.svg')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        return f.read()
-
-
-
-def get_wrapped_name_svg(name):
-    """Wrap name for ID card into SVG tspans with dynamic font size."""
-    # Clean non-ascii
-    name = re.sub(r'[^\x00-\x7F]+', '', name).strip()
-    
-    words = name.split()
-    if not words: return "", 50
-    
-    full_name_len = len(name)
-    
-    # IMPROVED: Prefer single line if possible up to 20 chars
-    if full_name_len <= 20:
-        fontsize = 45 if full_name_len <= 15 else 35
-        return f'<tspan x="300" dy="1.2em">{name}</tspan>', fontsize
-    
-    # Case 2: Medium name (2 lines) - split evenly-ish
-    if full_name_len <= 35:
-        mid = len(words) // 2
-        if len(words) > 1:
-            line1 = words[0]
-            line2_words = words[1:]
-            current_len = len(line1)
-            idx = 1
-            while idx < len(words):
-                if current_len + 1 + len(words[idx]) < 18: 
-                    line1 += " " + words[idx]
-                    current_len += 1 + len(words[idx])
-                    idx += 1
-                else:
-                    break
-            line2 = " ".join(words[idx:])
-            return f'<tspan x="300" dy="0">{line1}</tspan><tspan x="300" dy="1.2em">{line2}</tspan>', 40
-        else:
-             # Single long word
-             return f'<tspan x="300" dy="1.2em">{name}</tspan>', 30
-
-    # Case 3: Long name (2-3 lines)
-    # Simple strategy: Max 3 lines
-    lines = []
-    current_line = ""
-    for word in words:
-        if len(current_line) + len(word) + 1 <= 18:
-            if current_line: current_line += " "
-            current_line += word
-        else:
-            if current_line: lines.append(current_line)
-            current_line = word
-    if current_line: lines.append(current_line)
-    
-    if len(lines) == 1:
-         return f'<tspan x="300" dy="1.2em">{lines[0]}</tspan>', 35
-    elif len(lines) == 2:
-         return f'<tspan x="300" dy="0">{lines[0]}</tspan><tspan x="300" dy="1.2em">{lines[1]}</tspan>', 35
-    else:
-         # 3 or more lines, shrink font
-         svg_lines = []
-         svg_lines.append(f'<tspan x="300" dy="-0.5em">{lines[0]}</tspan>')
-         for l in lines[1:3]: # Take max 3 lines
-             svg_lines.append(f'<tspan x="300" dy="1.1em">{l}</tspan>')
-         return "".join(svg_lines), 30
-
-def get_qr_base64(name, roll, date, cert_id, domain=None):
-    raw_data = f"{name};{roll};{date};{cert_id}"
-    encoded_data = base64.urlsafe_b64encode(raw_data.encode()).decode()
-    if not domain:
-        # Fallback if no domain passed (e.g. single gen route)
-        domain = request.host_url.rstrip('/')
-    url = f"{domain}/v#{encoded_data}"
-    
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=2,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
-
-
-
-def convert_image_to_base64(image_bytes):
-    """Convert any image format to PNG base64 data URI."""
-    if not image_bytes:
-        return ""
+    """Load the SVG template (cached until the file changes)."""
+    from render_engine import cached_template
+    return cached_template(TEMPLATE_PATH)
+
+def preload_assets():
+    """Import the render and ingest stack and warm the shared assets.
+
+    Called in the gunicorn master before it forks (see gunicorn.conf.py), so
+    workers share the imported modules, template, decoded signature and
+    static certificate layers copy-on-write instead of each loading them on
+    its first request.
+    """
+    started = time.perf_counter()
+    # Imported for their side effect of being loaded (smart_ingestion defers pandas)
+    import pandas
+    import pdf_export
+    import render_service
+    import smart_ingestion
+    from render_engine import RenderEngine
     try:
-        img = Image.open(BytesIO(image_bytes))
-        # Convert to RGB if necessary (for RGBA or P mode images)
-        if img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
-        # Save as PNG
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        return f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
+        # Static layers don't depend on the domain; per-run engines reuse them
+        RenderEngine(load_svg_template(), SIGNATURE_PATH, None).warm()
     except Exception as e:
-        print(f"Error converting image: {e}")
-        return ""
+        log.warning("Could not prerender static layers: %s", e)
+    seconds = time.perf_counter() - started
+    STARTUP_SECONDS.set(seconds, phase='preload')
+    log.info("Preloaded render assets in %.0f ms (%s)", seconds * 1000, memory_summary())
 
-import traceback
 
-def log_error(e):
-    with open("error.log", "a") as f:
-        f.write(f"ERROR: {str(e)}\n")
-        f.write(traceback.format_exc())
-        f.write("\n" + "-"*50 + "\n")
-    print(f"ERROR: {e}", file=sys.stderr)
 
 @app.route('/')
 def index():
@@ -145,28 +71,106 @@ def index():
 
 @app.route('/test', methods=['GET', 'POST'])
 def test_route():
-    print("DEBUG: Entered test_route")
+    log.debug("Entered test_route")
     return "OK", 200
 
 @app.before_request
 def log_request_info():
-    print(f"DEBUG: Request Path: {request.path} Method: {request.method}")
+    flask.g.request_start = time.perf_counter()
+    log.debug("Request Path: %s Method: %s", request.path, request.method)
+
+@app.after_request
+def record_request_metrics(response):
+    start = flask.g.pop('request_start', None)
+    # Label by URL rule, not path, so run ids don't explode the series count
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if start is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus scrape endpoint."""
+    sample_process_memory()
+    if not os.environ.get('RENDER_SERVICE_ADDRESS'):  # render_service.SERVICE_ADDRESS_ENV
+        return flask.Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+    # Renders are counted in the dedicated render server, not in this worker
+    try:
+        render_metrics = _render_service().metrics()
+    except Exception as e:
+        log.warning("Could not fetch render metrics: %s", e)
+        render_metrics = ''
+    return flask.Response(REGISTRY.render(exclude=RENDER_METRICS) + render_metrics,
+                          mimetype='text/plain; version=0.0.4')
+
+def _run_metadata(run_dir):
+    try:
+        with open(os.path.join(run_dir, 'metadata.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _run_profile(meta):
+    """Output profile of a run (runs from before profiles were print PNGs)."""
+    try:
+        return get_profile(meta.get('profile'))
+    except ValueError:
+        return get_profile()
+
+def _clear_pdf_cache(run_dir):
+    """Drop merged PDFs cached for a run whose certificates are about to change."""
+    for f in os.listdir(run_dir):
+        if f.startswith('All_Certificates.') and f.endswith('.pdf'):
+            os.remove(os.path.join(run_dir, f))
+
+def _render_service():
+    from render_service import get_render_service
+    return get_render_service(TEMPLATE_PATH, SIGNATURE_PATH)
+
+def _ambiguous_photos(ingestor, profile):
+    """Rows whose photo was picked from several matches, keyed to their certificate files."""
+    from render_engine import get_record_filename
+    return [{'filename': get_record_filename(entry['record'], profile['ext']),
+             'roll': entry['roll'], 'name': entry['name'], 'match_type': entry['match_type'],
+             'chosen': entry['chosen'], 'candidates': entry['candidates']}
+            for entry in ingestor.ambiguous_matches]
 
 @app.route('/smart', methods=['POST'])
 def smart_generate():
-    print("DEBUG: Entered smart_generate")
     """Universal generation route for CSV/Excel/PDF + Images."""
+    log.debug("Entered smart_generate")
     data_file = request.files.get('data_file') # csv, xlsx, pdf
     photos_zip = request.files.get('photos_zip')
     
     if not data_file:
         return "No data file provided", 400
-
-    ingestor = SmartIngestor()
+    try:
+        profile = get_profile(request.form.get('profile'))
+    except ValueError as e:
+        return str(e), 400
+
+    from render_engine import photo_slot
+    from smart_ingestion import SmartIngestor
+    # Photos are fitted to the template's photo slot at this run's DPI while ingesting
+    ingestor = SmartIngestor(photo_slot=photo_slot(load_svg_template(), profile))
     
-    # Create unique run directory
+    # Create unique run directory, or re-use an earlier run for a corrected
+    # roster: its manifest lets the worker re-render only the changed records
     run_id = str(uuid.uuid4())
     base_temp_dir = os.path.join(app.root_path, 'temp_runs') # Base temp folder
+    previous_run = request.form.get('run_id')
+    if previous_run:
+        try:
+            previous_run = str(uuid.UUID(previous_run))
+        except ValueError:
+            return "Invalid run id", 400
+        if not os.path.isdir(os.path.join(base_temp_dir, previous_run)):
+            return "Run ID not found or expired.", 404
+        if _render_service().is_active(previous_run):
+            return "That run is still being generated.", 409
+        run_id = previous_run
+        _clear_pdf_cache(os.path.join(base_temp_dir, run_id))
     run_dir = os.path.join(base_temp_dir, run_id)
     img_out_dir = os.path.join(run_dir, 'certificates')
     os.makedirs(img_out_dir, exist_ok=True)
@@ -184,65 +188,49 @@ def smart_generate():
     input_save_path = os.path.join(run_dir, data_file.filename)
     data_file.save(input_save_path)
         
+    # Opt-in: profile ingestion here and rendering in the workers (<run_dir>/profile)
+    diagnostics = request.form.get('diagnostics') == 'on'
+    profiler = get_run_profiler(run_dir, 'ingest') if diagnostics else None
+        
     try:
-        # Process Data
-        success, msg = ingestor.process_data_file(input_save_path)
-        if not success:
-            return f"Error processing data file: {msg}", 400
+        with profiler.capture() if profiler else contextlib.nullcontext():
+            photo_zip_path = None
+            if photos_zip:
+                photo_zip_path = os.path.join(run_dir, photos_zip.filename)
+                photos_zip.save(photo_zip_path)
             
-        # Process Photos
-        if photos_zip:
-            photo_zip_path = os.path.join(run_dir, photos_zip.filename)
-            photos_zip.save(photo_zip_path)
-            ingestor.process_images(zip_path=photo_zip_path)
-        
-        # Prepare for Batch Processing
-        import subprocess
-        import json
-        
-        # Save records to JSON
-        records_path = os.path.join(run_dir, 'records.json')
-        with open(records_path, 'w') as f:
-            json.dump(records, f)
+            # Parse and photo-match the roster batch by batch, straight into the run store:
+            # records as JSON lines, photos packed into one blob the workers memory-map
+            batches = ingestor.iter_record_batches(input_save_path, zip_path=photo_zip_path)
+            try:
+                total = write_run(run_dir, (item for batch in batches for item in batch))
+            except ValueError as e:
+                return f"Error processing data file: {e}", 400
+        if profiler:
+            profiler.dump()
             
         # Save Metadata
         metadata = {
-            'total': len(records),
+            'total': total,
             'timestamp': time.time(),
-            'status': 'processing'
+            'status': 'processing',
+            'domain': request.host_url.rstrip('/'),
+            'profile': profile['name'],
+            'ambiguous': _ambiguous_photos(ingestor, profile),
         }
         metadata_path = os.path.join(run_dir, 'metadata.json')
         with open(metadata_path, 'w') as f:
             json.dump(metadata, f)
             
-        # Paths for worker
-        template_path = os.path.join(app.root_path, 'templates', 'certificate_template.svg')
-        signature_path = os.path.join(app.root_path, 'signature.png')
-        domain = request.host_url.rstrip('/')
-        
-        # Spawn Async Worker
-        print("DEBUG: Spawning batch_processor.py details...")
-        cmd = [
-            sys.executable, 'batch_processor.py', 
-            '--run_dir', run_dir,
-            '--domain', domain,
-            '--template', template_path,
-            '--signature', signature_path
-        ]
-        
-        # Use Popen to run in background (independent process)
-        # On Windows, we need creationflags=subprocess.DETACHED_PROCESS or shell=True to avoid killing it if parent dies? 
-        # Actually standard Popen is fine as long as we don't wait()
-        # creationflags=0x00000008 (DETACHED_PROCESS) is good but tricky with console.
-        # simple Popen is usually enough for "fire and forget" in this context
-        
-        subprocess.Popen(cmd)
+        # Hand the run to the shared render service (warm pool, fair across runs)
+        _render_service().submit(run_id, run_dir, request.host_url.rstrip('/'), profile=profile['name'],
+                                 diagnostics=diagnostics)
         
-        print("DEBUG: Async worker spawned. Redirecting to preview.")
+        log.debug("Run queued. Redirecting to preview.")
         return flask.redirect(flask.url_for('preview_route', run_id=run_id))
 
     except Exception as e:
-        log_error(e)
+        log.exception("Smart generation failed: %s", e)
         return f"Internal Server Error: {e}", 500
 
 @app.route('/preview/<run_id>')
@@ -251,26 +239,122 @@ def preview_route(run_id):
     base_temp_dir = os.path.join(app.root_path, 'temp_runs')
     run_dir = os.path.join(base_temp_dir, run_id)
     img_out_dir = os.path.join(run_dir, 'certificates')
-    metadata_path = os.path.join(run_dir, 'metadata.json')
     
     if not os.path.exists(run_dir):
         return "Run ID not found or expired.", 404
+    
+    meta = _run_metadata(run_dir)
+    profile = _run_profile(meta)
         
-    filenames = []
-    if os.path.exists(img_out_dir):
-        filenames = sorted([f for f in os.listdir(img_out_dir) if f.lower().endswith('.png')])
+    # Finished files come from the worker's completed.log; the page then
+    # follows /progress/<run_id>/stream from this offset instead of reloading.
+    filenames, log_offset = read_completed(run_dir)
+    if not filenames and os.path.exists(img_out_dir) and read_progress(run_dir) is None:
+        filenames = sorted([f for f in os.listdir(img_out_dir) if f.lower().endswith(profile['ext'])])
         
-    total_count = 0
-    if os.path.exists(metadata_path):
-        try:
-            with open(metadata_path, 'r') as f:
-                meta = json.load(f)
-                total_count = meta.get('total', 0)
-        except: pass
+    total_count = meta.get('total', 0)
+    status = meta.get('status', 'processing')
         
     if total_count == 0: total_count = len(filenames) # fallback
     
-    return render_template('preview.html', run_id=run_id, filenames=filenames, total_count=total_count, current_count=len(filenames))
+    return render_template('preview.html', run_id=run_id, filenames=filenames, total_count=total_count,
+                           current_count=len(filenames), log_offset=log_offset, status=status,
+                           show_images=is_raster(profile), profile=profile['name'],
+                           ambiguous=meta.get('ambiguous', []))
+
+def _progress_payload(run_dir, since):
+    progress = read_progress(run_dir)
+    if progress is None:
+        # Worker has not published yet: fall back to the metadata written at upload
+        progress = {'status': 'queued', 'total': 0, 'done': 0, 'failed': 0}
+        try:
+            with open(os.path.join(run_dir, 'metadata.json'), 'r') as f:
+                progress['total'] = json.load(f).get('total', 0)
+        except (OSError, ValueError): pass
+    files, offset = read_completed(run_dir, since)
+    progress['files'] = files
+    progress['offset'] = offset
+    return progress
+
+@app.route('/progress/<run_id>')
+def progress_route(run_id):
+    """Progress as JSON; ``?since=<offset>`` returns only newly finished files."""
+    run_dir = os.path.join(app.root_path, 'temp_runs', run_id)
+    if not os.path.exists(run_dir):
+        return flask.jsonify({'error': 'Run ID not found or expired.'}), 404
+    since = request.args.get('since', 0, type=int)
+    response = flask.jsonify(_progress_payload(run_dir, since))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Each SSE response ends after this long (well under gunicorn's timeout); the client reconnects
+SSE_STREAM_SECONDS = 60
+# Open SSE streams per process; each holds a request thread, so past this the
+# preview gets a 503 and falls back to polling /progress
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 2))
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+@app.route('/progress/<run_id>/stream')
+def progress_stream_route(run_id):
+    """Server-Sent Events feed of progress; event id is the completed.log offset."""
+    run_dir = os.path.join(app.root_path, 'temp_runs', run_id)
+    if not os.path.exists(run_dir):
+        return "Run ID not found or expired.", 404
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    if not _sse_slots.acquire(blocking=False):
+        return flask.Response("Too many progress streams, poll /progress instead.", status=503,
+                              headers={'Retry-After': str(SSE_STREAM_SECONDS)})
+
+    def events(offset):
+        last_update = None
+        last_sent = time.time()
+        # Short-lived: EventSource reconnects with Last-Event-ID, so a stream
+        # never pins a worker thread for long
+        deadline = time.time() + SSE_STREAM_SECONDS
+        while time.time() < deadline:
+            payload = _progress_payload(run_dir, offset)
+            if payload['files'] or payload.get('updated_at') != last_update:
+                offset = payload['offset']
+                last_update = payload.get('updated_at')
+                last_sent = time.time()
+                yield f"id: {offset}\ndata: {json.dumps(payload)}\n\n"
+                if payload['status'] in FINAL_STATUSES:
+                    yield "event: done\ndata: {}\n\n"
+                    return
+            elif time.time() - last_sent > 15:
+                last_sent = time.time()
+                yield ": keepalive\n\n"
+            time.sleep(1)
+
+    response = flask.Response(events(since), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs even if the stream never started (client gone before the first byte)
+    response.call_on_close(_sse_slots.release)
+    return response
+
+@app.route('/retry/<run_id>', methods=['POST'])
+def retry_route(run_id):
+    """Render a run again; only failed, missing or changed certificates are redone."""
+    run_dir = os.path.join(app.root_path, 'temp_runs', run_id)
+    if not os.path.exists(run_dir):
+        return flask.jsonify({'error': 'Run ID not found or expired.'}), 404
+    meta = _run_metadata(run_dir)
+    _clear_pdf_cache(run_dir)
+    try:
+        queued = _render_service().submit(run_id, run_dir, meta.get('domain') or request.host_url.rstrip('/'),
+                                          profile=_run_profile(meta)['name'])
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 409
+    return flask.jsonify({'queued': queued})
+
+@app.route('/cancel/<run_id>', methods=['POST'])
+def cancel_route(run_id):
+    """Cancel a queued or running generation."""
+    if not _render_service().cancel(run_id):
+        return flask.jsonify({'cancelled': False, 'error': 'Run is not active.'}), 404
+    return flask.jsonify({'cancelled': True})
 
 @app.route('/download/zip/<run_id>')
 def download_zip_route(run_id):
@@ -282,13 +366,31 @@ def download_zip_route(run_id):
     if not os.path.exists(img_out_dir):
         return "Run ID not found.", 404
         
-    # Zip the output directory if not already zipped? 
-    # Or just re-zip to be safe (or check if exists)
-    zip_path = os.path.join(run_dir, 'Certificates.zip')
-    if not os.path.exists(zip_path):
-        shutil.make_archive(os.path.join(run_dir, 'Certificates'), 'zip', img_out_dir)
-        
-    return send_file(zip_path, as_attachment=True, download_name='Certificates.zip')
+    # Stream the archive as it is built (PNGs stored, not deflated) from the
+    # certificates finished so far; nothing is cached so it never goes stale.
+    ext = _run_profile(_run_metadata(run_dir))['ext']
+    return flask.Response(
+        flask.stream_with_context(iter_zip_dir(img_out_dir, (ext,))),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=Certificates.zip'}
+    )
+
+def _tee_to_file(chunks, path):
+    """Pass chunks through while saving them; the file only appears once complete."""
+    # A temp file per response: concurrent downloads of one run must not share it
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                     suffix='.part')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(part_path, path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(part_path):
+            os.remove(part_path)
 
 @app.route('/download/pdf/<run_id>')
 def download_pdf_route(run_id):
@@ -301,35 +403,42 @@ def download_pdf_route(run_id):
         if not os.path.exists(img_out_dir):
             return "Run ID not found.", 404
             
-        pdf_path = os.path.join(run_dir, 'All_Certificates.pdf')
+        meta = _run_metadata(run_dir)
+        profile = _run_profile(meta)
         
-        # If already exists, return
+        # Only certificates that have finished rendering become pages
+        filenames = sorted([f for f in os.listdir(img_out_dir) if f.lower().endswith(profile['ext'])])
+        if not filenames:
+            return "No certificates found to merge.", 404
+        
+        # Cached per finished-set size, so a PDF taken mid-run is never reused
+        pdf_path = os.path.join(run_dir, f'All_Certificates.{len(filenames)}.pdf')
         if os.path.exists(pdf_path):
              return send_file(pdf_path, as_attachment=True, download_name='All_Certificates.pdf')
         
-        # Generate PDF
-        filenames = sorted([f for f in os.listdir(img_out_dir) if f.lower().endswith('.png')])
-        if not filenames:
-            return "No certificates found to merge.", 404
-            
-        # Helper to open images
-        image_list = []
-        for fname in filenames:
-            img_path = os.path.join(img_out_dir, fname)
-            img = Image.open(img_path)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            image_list.append(img)
-            
-        if image_list:
-            first_img = image_list[0]
-            rest_imgs = image_list[1:]
-            first_img.save(pdf_path, "PDF", resolution=100.0, save_all=True, append_images=rest_imgs)
-            
-        return send_file(pdf_path, as_attachment=True, download_name='All_Certificates.pdf')
+        if has_run(run_dir) or os.path.exists(os.path.join(run_dir, 'records.json')):
+            # Vector pages re-rendered from each record's SVG
+            records = load_records(run_dir)
+            domain = meta.get('domain') or request.host_url.rstrip('/')
+            from pdf_export import iter_merged_pdf
+            from render_engine import fit_roster_qr_version, get_engine
+            engine = get_engine(load_svg_template(), SIGNATURE_PATH, domain,
+                                qr_version=fit_roster_qr_version(records, domain) if records else None)
+            pages = iter_merged_pdf(
+                engine.iter_svgs(records, set(filenames), open_photo_blob(run_dir), profile['ext']),
+                url_fetcher=engine.registry.url_fetcher)
+        else:
+            from pdf_export import iter_raster_pdf
+            pages = iter_raster_pdf(os.path.join(img_out_dir, f) for f in filenames)
+        
+        return flask.Response(
+            flask.stream_with_context(_tee_to_file(pages, pdf_path)),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': 'attachment; filename=All_Certificates.pdf'}
+        )
         
     except Exception as e:
-        log_error(e)
+        log.exception("PDF export failed: %s", e)
         return f"Error generating PDF: {e}", 500
 
 @app.route('/temp_runs/<run_id>/certificates/<filename>')
@@ -343,115 +452,181 @@ def serve_temp_image(run_id, filename):
 @app.route('/generate', methods=['POST'])
 def generate():
     try:
-        raw_name = request.form.get('name', '')
-        name = re.sub(r'[^\x00-\x7F]+', '', raw_name).strip().upper()
-        if not name: name = "UNKNOWN"
-        
-        roll = request.form.get('roll_no', '')
-        date = request.form.get('date', '') 
         photo_file = request.files.get('photo')
+        rec = {
+            'name': request.form.get('name', ''),
+            'roll': request.form.get('roll_no', ''),
+            'date': request.form.get('date', ''),
+            'photo': photo_file.read() if photo_file else None,
+        }
+        # Same engine as the batch path; re-issued certificates come from the render cache
+        from render_engine import get_cert_id, get_display_name, get_engine, get_roll
+        engine = get_engine(load_svg_template(), SIGNATURE_PATH, request.host_url.rstrip('/'))
+        result = engine.render(rec)
+        if not result['ok']:
+            return "Internal Server Error: could not render certificate", 500
+        # Not registered as issued: anyone can post this form, so its QR only validates
+        # once the same certificate comes out of a run
+        b64_img = base64.b64encode(result['data']).decode()
         
-        cert_id = f"AIK{roll}"
-        qr_b64 = get_qr_base64(name, roll, date, cert_id)
-        photo_b64 = f"data:image/png;base64,{base64.b64encode(photo_file.read()).decode()}" if photo_file else ""
-
-        # Main Font Size Calc
-        name_len = len(name)
-        if name_len <= 15: main_fontsize = 160
-        elif name_len <= 20: main_fontsize = 140
-        elif name_len <= 30: main_fontsize = 110
-        elif name_len <= 40: main_fontsize = 90
-        else: main_fontsize = 70
-
-        # Get fixed signature
-        with open("signature.png", "rb") as f:
-            sig_b64 = f"data:image/png;base64,{base64.b64encode(f.read()).decode()}"
-
-        svg_template = load_svg_template()
-        id_name_content, id_name_fontsize = get_wrapped_name_svg(name)
-        svg_data = svg_template.format(
-            name=name, 
-            roll_no=roll, 
-            photo_base64=photo_b64, 
-            qr_base64=qr_b64, 
-            cert_id=cert_id, 
-            signature_base64=sig_b64,
-            id_name_content=id_name_content,
-            id_name_fontsize=id_name_fontsize,
-            main_name_fontsize=main_fontsize,
-            date=date
-        )
-        png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-        b64_img = base64.b64encode(png_data).decode()
-        
-        certs = [{'name': name, 'roll': roll, 'image': f"data:image/png;base64,{b64_img}", 'cert_id': cert_id}]
+        certs = [{'name': get_display_name(rec), 'roll': get_roll(rec),
+                  'image': f"data:image/png;base64,{b64_img}", 'cert_id': get_cert_id(rec)}]
 
         return render_template('results.html', certificates=certs)
     except Exception as e:
-        log_error(e)
+        log.exception("Single certificate generation failed: %s", e)
         return f"Internal Server Error: {e}", 500
 
-
-def generate_single_certificate(rec, svg_template, sig_b64, img_out_dir, domain):
-    """Helper to generate one certificate (render, convert, save)."""
+# <path:> because rolls may contain '/' (even quoted as %2F, it is decoded before routing)
+@app.route('/validate/<path:cert_id>')
+def validate_route(cert_id):
+    """Verification page the certificates' QR codes point at (JSON for API clients)."""
+    from cert_registry import CACHE_TTL, MISS_TTL, get_cert_registry
+    cert_id = cert_id.strip().upper()
+    entry, cached = get_cert_registry().lookup(cert_id)
+    VALIDATIONS.inc(result='valid' if entry else 'unknown', source='cache' if cached else 'database')
+    # Public fields only: the run id would give access to the run's files
+    certificate = {k: entry[k] for k in ('cert_id', 'name', 'roll', 'date')} if entry else None
+    if request.args.get('format') == 'json' or \
+            request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        response = flask.jsonify(valid=bool(entry), cert_id=cert_id, certificate=certificate)
+    else:
+        response = flask.make_response(render_template('validate.html', cert_id=cert_id, certificate=certificate))
+    response.status_code = 200 if entry else 404
+    # Scan bursts are served by browsers and proxies; unknown ids are re-checked sooner
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_TTL if entry else MISS_TTL
+    response.vary.add('Accept')
+    if entry:
+        response.set_etag(f"{cert_id}-{entry['issued_at']}")
+        response.make_conditional(request)
+    return response
+
+# Most records one /api/generate request may carry
+API_MAX_RECORDS = int(os.environ.get('API_MAX_RECORDS', 5000))
+# How often /api/generate checks results.log for new results
+RESULTS_POLL_SECONDS = 0.2
+# Longest a /api/generate response waits for its run before giving up
+API_STREAM_SECONDS = int(os.environ.get('API_STREAM_SECONDS', 3600))
+
+def _service_has_run(service, run_id):
+    """False once the run has left the render service, or the service is unreachable."""
     try:
-        raw_name = str(rec.get('name', 'Unknown'))
-        name = re.sub(r'[^\x00-\x7F]+', '', raw_name).strip().upper()
-        if not name: name = "UNKNOWN"
-
-        roll = str(rec.get('roll', 'N/A')).upper()
-        date_val = str(rec.get('date', '08-02-2026')) 
-        
-        cert_id = f"AIK{roll}"
-        qr_b64 = get_qr_base64(name, roll, date_val, cert_id, domain)
-        photo_b64 = rec.get('photo_base64', '')
-        
-        # Main Font Size Calc
-        name_len = len(name)
-        if name_len <= 15: main_fontsize = 160
-        elif name_len <= 20: main_fontsize = 140
-        elif name_len <= 30: main_fontsize = 110
-        elif name_len <= 40: main_fontsize = 90
-        else: main_fontsize = 70
-
-        id_name_content, id_name_fontsize = get_wrapped_name_svg(name)
-        svg_data = svg_template.format(
-            name=name, 
-            roll_no=roll, 
-            photo_base64=photo_b64, 
-            qr_base64=qr_b64, 
-            cert_id=cert_id,
-            signature_base64=sig_b64,
-            id_name_content=id_name_content,
-            id_name_fontsize=id_name_fontsize,
-            main_name_fontsize=main_fontsize,
-            date=date_val
-        )
-        
-        png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-        
-        # Save PNG to disk
-        # Sanitize filename
-        safe_name = re.sub(r'[^a-zA-Z0-9_\-]', '_', name)
-        safe_roll = re.sub(r'[^a-zA-Z0-9_\-]', '_', roll)
-        filename = f"{safe_roll}_{safe_name}.png"
-        
-        # Use a safe path join
-        out_path = os.path.join(img_out_dir, filename)
-        with open(out_path, 'wb') as f:
-            f.write(png_data)
-            
+        return service.is_active(run_id)
     except Exception as e:
-        print(f"Error generating for {rec.get('name')}: {e}")
-        raise e
-
-
-
-
-
+        log.warning("Render service unreachable: %s", e)
+        return False
+
+def _api_items(records):
+    """(record, photo bytes) for API records; 'photo_base64' is a data URI or bare base64.
+
+    Photos are stored as sent: the render workers fit them to the template's
+    slot when they are first drawn (AssetRegistry.get_fitted for raster
+    layers, fitted_ref for cairosvg), so nothing is decoded here.
+    """
+    for rec in records:
+        rec = dict(rec)
+        photo = str(rec.pop('photo_base64', '') or '')
+        if photo.startswith('data:'):
+            photo = photo.partition(',')[2]
+        try:
+            photo = base64.b64decode(photo) if photo else None
+        except ValueError as e:
+            log.warning("Ignoring unreadable photo for %s: %s", rec.get('roll'), e)
+            photo = None
+        yield rec, photo
+
+@app.route('/api/generate', methods=['POST'])
+def api_generate_route():
+    """Bulk generation for other systems: JSON records in, NDJSON results out.
+
+    The body is ``{"records": [{"name", "roll", "date", "photo_base64"}, ...],
+    "profile": "web"}`` or a bare list of records. Each response line reports
+    one certificate as soon as it finishes (completion order): cert_id,
+    status, url and render_ms. It is an ordinary run (``X-Run-Id`` header),
+    so the preview, ZIP and PDF routes work for it too. If the run stops
+    without finishing (or API_STREAM_SECONDS pass), the last line is
+    ``{"error", "run_id"}``.
+    """
+    payload = request.get_json(silent=True)
+    records = payload.get('records') if isinstance(payload, dict) else payload
+    if not isinstance(records, list) or not all(isinstance(rec, dict) for rec in records):
+        return flask.jsonify(error='Expected a JSON list of records or {"records": [...]}'), 400
+    if len(records) > API_MAX_RECORDS:
+        return flask.jsonify(error=f"At most {API_MAX_RECORDS} records per request"), 413
+    try:
+        profile = get_profile(payload.get('profile') if isinstance(payload, dict) else None)
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
 
+    run_id = str(uuid.uuid4())
+    run_dir = os.path.join(app.root_path, 'temp_runs', run_id)
+    os.makedirs(os.path.join(run_dir, 'certificates'), exist_ok=True)
+    domain = request.host_url.rstrip('/')
+    total = write_run(run_dir, _api_items(records))
+    with open(os.path.join(run_dir, 'metadata.json'), 'w') as f:
+        json.dump({'total': total, 'timestamp': time.time(), 'status': 'processing',
+                   'domain': domain, 'profile': profile['name'], 'source': 'api'}, f)
+
+    # Results land in the run dir's results.log, whichever process renders them
+    service = _render_service()
+    service.submit(run_id, run_dir, domain, profile=profile['name'], results_log=True)
+
+    def stream():
+        finished = False
+        offset = 0
+        deadline = time.monotonic() + API_STREAM_SECONDS
+        stopped = False
+        try:
+            while True:
+                entries, offset = read_results(run_dir, offset)
+                for entry in entries:
+                    if entry.get('done'):
+                        finished = True
+                        return
+                    filename = entry.get('filename')
+                    yield json.dumps({
+                        'cert_id': entry['cert_id'],
+                        'status': 'ok' if entry['ok'] else 'failed',
+                        'url': flask.url_for('serve_temp_image', run_id=run_id, filename=filename, _external=True)
+                               if entry['ok'] and filename else None,
+                        'render_ms': entry['render_ms'],
+                    }) + '\n'
+                if entries:
+                    continue
+                error = None
+                if time.monotonic() > deadline:
+                    error = 'Timed out waiting for the remaining certificates'
+                elif stopped:
+                    # Still nothing after the run left the service: the final line never comes
+                    error = 'The render service stopped before the run finished'
+                elif not _service_has_run(service, run_id):
+                    stopped = True  # its 'done' line is written first: read once more
+                    continue
+                if error:
+                    yield json.dumps({'error': error, 'run_id': run_id}) + '\n'
+                    return
+                time.sleep(RESULTS_POLL_SECONDS)
+        finally:
+            if not finished:
+                # Client went away (or we gave up): stop rendering certificates nobody will collect
+                try:
+                    service.cancel(run_id)
+                except Exception as e:
+                    log.warning("Could not cancel run %s: %s", run_id, e)
+
+    return flask.Response(flask.stream_with_context(stream()), mimetype='application/x-ndjson',
+                          headers={'X-Run-Id': run_id})
+
+_import_seconds = time.perf_counter() - _IMPORT_STARTED
+STARTUP_SECONDS.set(_import_seconds, phase='import')
+log.info("App imported in %.0f ms (%s)", _import_seconds * 1000, memory_summary())
+
+if __name__ == "__main__":
     print(app.url_map)
     port = int(os.environ.get("PORT", 5003))
+    if os.environ.get('PRELOAD_ASSETS') == '1':
+        preload_assets()
 
     # Register Cleanup on Exit
     import atexit
@@ -475,4 +650,3 @@ def generate_single_certificate(rec, svg_template, sig_b64, img_out_dir, domain)
     signal.signal(signal.SIGTERM, cleanup_temp_files)
 
     app.run(host='0.0.0.0', port=port)
-
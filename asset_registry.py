@@ -0,0 +1,242 @@
+"""Per-process registry of decoded images referenced from SVGs as ``asset:<key>``.
+
+Instead of base64-inlining the signature, photos and QR codes into every SVG
+string, callers register the raw bytes (or an already built PIL image) once and
+put the returned reference in the ``href``. The registry decodes each distinct
+image a single time and serves it to cairosvg through ``url_fetcher`` or to the
+layered renderer directly as a PIL image.
+"""
+import base64
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+SCHEME = 'asset:'
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)  # EXIF orientations that swap width and height
+
+
+def is_asset_ref(value):
+    return isinstance(value, str) and value.startswith(SCHEME)
+
+
+def _safe_fetch(url, resource_type):
+    # Same policy as cairosvg's default: only data URLs, never files or network
+    from cairosvg.url import safe_fetch
+    return safe_fetch(url, resource_type)
+
+
+class AssetRegistry:
+    """Bounded LRU of image sources, decoded images and PNG encodings."""
+
+    def __init__(self, max_items=128):
+        self.max_items = max_items
+        self._sources = OrderedDict()  # key -> bytes | PIL.Image | file path
+        self._images = OrderedDict()   # key -> decoded PIL.Image
+        self._png = OrderedDict()      # key -> PNG bytes for cairosvg
+        self._fitted = OrderedDict()   # (key, w, h, fit) -> resized PIL.Image
+        self._holders = {}             # key -> put_bytes/put_image calls not yet released
+        self._lock = threading.RLock() # request threads may share the registry
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_items:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _clean_key(key):
+        return re.sub(r'[^A-Za-z0-9_.\-]', '_', str(key))
+
+    def put_bytes(self, data, key=None):
+        """Register encoded image bytes; identical bytes share one entry."""
+        with self._lock:
+            if not data:
+                return ''
+            # Run-store photos are memoryview slices of an mmap: keep an owned copy
+            data = bytes(data)
+            key = self._clean_key(key) if key else hashlib.sha1(data).hexdigest()
+            if key not in self._sources:
+                self._remember(self._sources, key, data)
+            # Concurrent renders may share a photo (same sha1): each holds it until released
+            self._holders[key] = self._holders.get(key, 0) + 1
+            return SCHEME + key
+
+    def put_file(self, path, key=None):
+        """Register an image file; it is read lazily on first use."""
+        with self._lock:
+            key = self._clean_key(key or path)
+            if self._sources.get(key) != path:
+                self._drop(key)
+                self._remember(self._sources, key, path)
+            return SCHEME + key
+
+    def put_image(self, img, key):
+        """Register an already decoded PIL image (e.g. a freshly built QR)."""
+        with self._lock:
+            key = self._clean_key(key)
+            holders = self._holders.get(key, 0)
+            self._drop(key)
+            self._remember(self._sources, key, img)
+            self._remember(self._images, key, img)
+            self._holders[key] = holders + 1
+            return SCHEME + key
+
+    def put_data_uri(self, uri):
+        """Register a ``data:...;base64,`` URI, returning its reference."""
+        if not uri:
+            return ''
+        if is_asset_ref(uri):
+            return uri
+        _, _, payload = uri.partition(',')
+        return self.put_bytes(base64.b64decode(payload))
+
+    def resolve(self, value):
+        """Turn any href value (asset ref or data URI) into an asset ref."""
+        if not value or is_asset_ref(value):
+            return value
+        if value.startswith('data:'):
+            return self.put_data_uri(value)
+        return ''
+
+    def release(self, ref):
+        """Give up a per-record asset; it is dropped once its last holder releases it."""
+        with self._lock:
+            if not is_asset_ref(ref):
+                return
+            key = ref[len(SCHEME):]
+            holders = self._holders.get(key, 0) - 1
+            if holders > 0:
+                self._holders[key] = holders
+                return
+            self._drop(key)
+
+    def _drop(self, key):
+        self._holders.pop(key, None)
+        for cache in (self._sources, self._images, self._png):
+            cache.pop(key, None)
+        for fitted_key in [k for k in self._fitted if k[0] == key]:
+            del self._fitted[fitted_key]
+
+    def _raw_bytes(self, key):
+        source = self._sources[key]
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return f.read()
+        return source
+
+    def _decode(self, key, slot=None):
+        """Decode, orient and load the source bytes of ``key``.
+
+        With a ``slot`` (width, height, fit) JPEGs are decoded in draft mode at
+        the smallest DCT scale that still covers the fitted size, so a raw
+        12 MP photo is never fully decoded just to fill a small slot.
+        """
+        img = Image.open(BytesIO(self._raw_bytes(key)))
+        if slot and img.format == 'JPEG':
+            width, height, fit = slot
+            transposed = img.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS
+            src_w, src_h = img.size[::-1] if transposed else img.size
+            if fit == 'none':
+                size = (width, height)
+            else:
+                scale = (max if fit == 'slice' else min)(width / src_w, height / src_h)
+                size = (math.ceil(src_w * scale), math.ceil(src_h * scale))
+            img.draft('RGB', size[::-1] if transposed else size)
+        img = ImageOps.exif_transpose(img)
+        if img.mode == 'CMYK':
+            img = img.convert('RGB')
+        img.load()
+        return img
+
+    def get_image(self, ref):
+        """Decoded PIL image for ``ref`` (decoded at most once while cached)."""
+        with self._lock:
+            key = ref[len(SCHEME):]
+            img = self._images.get(key)
+            if img is None:
+                source = self._sources[key]
+                img = source if isinstance(source, Image.Image) else self._decode(key)
+                self._remember(self._images, key, img)
+            else:
+                self._images.move_to_end(key)
+            return img
+
+    def get_fitted(self, ref, width, height, fit='meet', align=(0.5, 0.5)):
+        """Image for ``ref`` resized to a width x height slot (SVG preserveAspectRatio)."""
+        with self._lock:
+            cache_key = (ref[len(SCHEME):], width, height, fit, align)
+            img = self._fitted.get(cache_key)
+            if img is None:
+                key = cache_key[0]
+                if key in self._images or isinstance(self._sources[key], Image.Image):
+                    src = self.get_image(ref)
+                else:
+                    # Only the fitted result is kept: a draft decode is too small for other slots
+                    src = self._decode(key, (width, height, fit))
+                if src.mode not in ('RGB', 'RGBA'):
+                    src = src.convert('RGBA' if src.has_transparency_data else 'RGB')
+                if fit == 'slice':
+                    img = ImageOps.fit(src, (width, height), Image.Resampling.LANCZOS, centering=align)
+                elif fit == 'none':
+                    img = src.resize((width, height), Image.Resampling.LANCZOS)
+                else:
+                    img = ImageOps.contain(src, (width, height), Image.Resampling.LANCZOS)
+                self._remember(self._fitted, cache_key, img)
+            return img
+
+    def fitted_ref(self, ref, width, height, fit='meet', align=(0.5, 0.5)):
+        """Reference to ``ref`` fitted to a width x height slot, for cairosvg.
+
+        The url_fetcher path (vector PDFs, full-SVG renders) would otherwise
+        embed photos at their uploaded size. The fitted copy is kept as PNG
+        bytes and left to the LRU, like any other cached encoding.
+        """
+        with self._lock:
+            key = self._clean_key(f"{ref[len(SCHEME):]}@{width}x{height}-{fit}-{align[0]}-{align[1]}")
+            if key not in self._sources:
+                buf = BytesIO()
+                self.get_fitted(ref, width, height, fit, align).save(buf, format='PNG', compress_level=1)
+                self._remember(self._sources, key, buf.getvalue())
+            else:
+                self._sources.move_to_end(key)
+            return SCHEME + key
+
+    def get_png(self, ref):
+        """PNG bytes for ``ref`` so cairosvg takes its direct PNG path."""
+        with self._lock:
+            key = ref[len(SCHEME):]
+            png = self._png.get(key)
+            if png is None:
+                source = self._sources[key]
+                if not isinstance(source, Image.Image):
+                    raw = self._raw_bytes(key)
+                    if raw.startswith(b'\x89PNG'):
+                        self._remember(self._png, key, raw)
+                        return raw
+                buf = BytesIO()
+                self.get_image(ref).save(buf, format='PNG', compress_level=1)
+                png = buf.getvalue()
+                self._remember(self._png, key, png)
+            return png
+
+    def url_fetcher(self, url, resource_type):
+        """cairosvg ``url_fetcher`` serving ``asset:`` URLs from the registry."""
+        if is_asset_ref(url):
+            return self.get_png(url)
+        return _safe_fetch(url, resource_type)
+
+
+_REGISTRY = None
+
+
+def get_registry():
+    """Process-wide registry (one per gunicorn / pool worker)."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = AssetRegistry()
+    return _REGISTRY
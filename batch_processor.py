@@ -1,146 +1,206 @@
 import os
-import json
 import argparse
-import base64
-import cairosvg
-import qrcode
-from io import BytesIO
-from PIL import Image
 import concurrent.futures
+import glob
+import itertools
 import time
-import re
 
-# Logic duplicated from app.py to ensure standalone execution without Flask context issues on Windows
+from cert_registry import issue_certificates
+from logs import get_logger, setup_logging
+from metrics import REGISTRY, profiled_call
+from output_profiles import DEFAULT_PROFILE, PROFILES, get_profile
+from progress import ProgressTracker, read_progress
+from qr_vector import fit_qr_version
+from render_engine import QR_ERROR_CORRECTION, get_engine, get_record_filename, get_record_validation_url
+from run_manifest import MANIFEST_FILE, RunManifest, record_fingerprint, settings_key
+from run_store import iter_records, load_records, open_photo_blob
+from zip_stream import iter_zip
 
-def load_text_file(path):
-    with open(path, 'r', encoding='utf-8') as f:
-        return f.read()
+log = get_logger('batch')
 
-def get_wrapped_name_svg(name):
-    """Wrap name for ID card into SVG tspans with dynamic font size."""
-    # Clean non-ascii (English only request)
-    name = re.sub(r'[^\x00-\x7F]+', '', name).strip()
-    
-    words = name.split()
-    if not words: return "", 50
-    full_name_len = len(name)
-    
-    # IMPROVED: Prefer single line if possible up to 20 chars
-    if full_name_len <= 20:
-        fontsize = 45 if full_name_len <= 15 else 35
-        return f'<tspan x="300" dy="1.2em">{name}</tspan>', fontsize
-
-    # Case 2: Medium name (2 lines) - split evenly-ish
-    if full_name_len <= 35: # Increased from 30
-        mid = len(words) // 2
-        if len(words) > 1:
-            line1 = words[0]
-            line2_words = words[1:]
-            current_len = len(line1)
-            idx = 1
-            while idx < len(words):
-                if current_len + 1 + len(words[idx]) < 18:
-                    line1 += " " + words[idx]
-                    current_len += 1 + len(words[idx])
-                    idx += 1
-                else:
-                    break
-            line2 = " ".join(words[idx:])
-            return f'<tspan x="300" dy="0">{line1}</tspan><tspan x="300" dy="1.2em">{line2}</tspan>', 40
-        else:
-            return f'<tspan x="300" dy="1.2em">{name}</tspan>', 30
-    
-    # Long name fallback
-    lines = []
-    current_line = ""
-    for word in words:
-        if len(current_line) + len(word) + 1 <= 18:
-            if current_line: current_line += " "
-            current_line += word
-        else:
-            if current_line: lines.append(current_line)
-            current_line = word
-    if current_line: lines.append(current_line)
-    
-    if len(lines) <= 1:
-         return f'<tspan x="300" dy="1.2em">{lines[0]}</tspan>', 35
-    elif len(lines) == 2:
-         return f'<tspan x="300" dy="0">{lines[0]}</tspan><tspan x="300" dy="1.2em">{lines[1]}</tspan>', 35
-    else:
-         svg_lines = []
-         svg_lines.append(f'<tspan x="300" dy="-0.5em">{lines[0]}</tspan>')
-         for l in lines[1:3]:
-             svg_lines.append(f'<tspan x="300" dy="1.1em">{l}</tspan>')
-         return "".join(svg_lines), 30
-
-def get_qr_base64(name, roll, date, cert_id, domain_url):
-    """Generate QR code base64 with validation URL."""
-    # Validation URL
-    validation_url = f"{domain_url}/validate/{cert_id}"
-    
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(validation_url)
-    qr.make(fit=True)
-
-    img_buffer = BytesIO()
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    qr_img.save(img_buffer, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(img_buffer.getvalue()).decode()}"
-
-def generate_single_certificate(rec, svg_template, sig_b64, img_out_dir, domain):
+def run_settings_key(svg_template, signature_path, domain, render_mode, qr_mode, qr_version, profile):
+    """Manifest key for everything a run's certificates share."""
+    return settings_key(svg_template, signature_path, domain=domain, render_mode=render_mode,
+                        qr_mode=qr_mode, qr_version=qr_version, profile=get_profile(profile))
+
+def plan_records(records, manifest, key, ext, photos=None, force=False):
+    """Yield (rec, filename, fingerprint, up_to_date) for each record.
+
+    ``up_to_date`` records were already rendered from identical inputs and
+    can be skipped (unless ``force``).
+    """
+    for rec in records:
+        filename = get_record_filename(rec, ext)
+        photo = photos.get(rec.get('photo')) if photos is not None else None
+        fingerprint = record_fingerprint(key, rec, photo)
+        yield rec, filename, fingerprint, not force and manifest.is_current(filename, fingerprint)
+
+def generate_single_certificate(rec, svg_template, signature_path, img_out_dir, domain, render_mode='layered',
+                                qr_mode='vector', qr_version=None, photos=None, profile=None):
+    """Render and save one certificate with the given output profile name.
+
+    Returns {'ok', 'filename', 'timings'}; see RenderEngine.render.
+    """
+    engine = get_engine(svg_template, signature_path, domain, render_mode, qr_mode, qr_version)
+    return engine.render(rec, profile, photos, img_out_dir)
+
+# Per-worker state set by the pool initializer, so each task only carries records
+_WORKER = {}
+
+def _init_worker(svg_template, signature_path, run_dir, domain, render_mode, qr_mode, qr_version, profile,
+                 diagnostics=False):
+    """Pool initializer: build the worker's engine and warm the static layers once."""
+    setup_logging()
+    _WORKER.update(engine=get_engine(svg_template, signature_path, domain, render_mode, qr_mode, qr_version),
+                   run_dir=run_dir, img_out_dir=os.path.join(run_dir, 'certificates'),
+                   photos=open_photo_blob(run_dir), profile=get_profile(profile), diagnostics=diagnostics)
     try:
-        raw_name = str(rec.get('name', 'Unknown'))
-        # ENFORCE ENGLISH ONLY (Remove non-ascii)
-        name = re.sub(r'[^\x00-\x7F]+', '', raw_name).strip().upper()
-        if not name: name = "UNKNOWN"
-        
-        roll = str(rec.get('roll', 'N/A')).upper()
-        date_val = str(rec.get('date', '08-02-2026')) 
-        
-        # Calculate Main Name Font Size
-        name_len = len(name)
-        if name_len <= 15: main_fontsize = 160
-        elif name_len <= 20: main_fontsize = 140
-        elif name_len <= 30: main_fontsize = 110
-        elif name_len <= 40: main_fontsize = 90
-        else: main_fontsize = 70
-        
-        cert_id = f"AIK{roll}"
-        qr_b64 = get_qr_base64(name, roll, date_val, cert_id, domain)
-        photo_b64 = rec.get('photo_base64', '')
-        
-        id_name_content, id_name_fontsize = get_wrapped_name_svg(name)
-        svg_data = svg_template.format(
-            name=name, 
-            roll_no=roll, 
-            photo_base64=photo_b64, 
-            qr_base64=qr_b64, 
-            cert_id=cert_id,
-            signature_base64=sig_b64,
-            id_name_content=id_name_content,
-            id_name_fontsize=id_name_fontsize,
-            main_name_fontsize=main_fontsize,
-            date=date_val
-        )
-        
-        png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-        
-        safe_name = re.sub(r'[^a-zA-Z0-9_\-]', '_', name)
-        safe_roll = re.sub(r'[^a-zA-Z0-9_\-]', '_', roll)
-        filename = f"{safe_roll}_{safe_name}.png"
-        
-        out_path = os.path.join(img_out_dir, filename)
-        with open(out_path, 'wb') as f:
-            f.write(png_data)
-        return True
+        _WORKER['engine'].warm(_WORKER['profile'])
     except Exception as e:
-        print(f"Error generating for {rec.get('name')}: {e}")
-        return False
+        log.warning("Worker warm-up failed: %s", e)
+
+def _render_chunk(records):
+    if _WORKER['diagnostics']:
+        return profiled_call(_WORKER['run_dir'], f"worker-{os.getpid()}", _render_records, records)
+    return _render_records(records)
+
+def _render_records(records):
+    return list(_WORKER['engine'].render_many(records, _WORKER['profile'], _WORKER['photos'], _WORKER['img_out_dir']))
+
+def default_worker_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # Windows / macOS
+        return os.cpu_count() or 1
+
+def iter_chunks(records, chunk_size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+SHARDS_DIR = 'shards'
+
+def parse_shard(spec):
+    """``'i/N'`` (1-based, as in ``--shard 2/4``) -> (i, N)."""
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}' (expected i/N, e.g. 1/4)")
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{spec}' (i must be between 1 and N)")
+    return index, count
+
+def parse_range(spec):
+    """``'START:END'`` record indices (END exclusive, may be omitted) -> (start, end)."""
+    try:
+        start, _, end = spec.partition(':')
+        start, end = int(start or 0), int(end) if end else None
+    except ValueError:
+        raise ValueError(f"Invalid record range '{spec}' (expected START:END, e.g. 0:5000)")
+    if start < 0 or (end is not None and end < start):
+        raise ValueError(f"Invalid record range '{spec}'")
+    return start, end
+
+def shard_range(total, index, count):
+    """Records [start, end) of shard ``index`` of ``count``: contiguous, sizes within one."""
+    return (index - 1) * total // count, index * total // count
+
+def shard_dir(run_dir, start, end):
+    """Where a shard keeps its partial manifest, progress and metrics."""
+    return os.path.join(run_dir, SHARDS_DIR, f"{start}-{end}")
+
+def scan_roster(run_dir, domain, ext, qr_mode):
+    """One streamed pass over the run: (output filenames in roster order, QR version).
+
+    Every shard scans the whole roster, so all of them pick the same QR version.
+    """
+    # One QR version for the whole roster: uniform module size, no per-record best fit
+    # Records are streamed (photos stay in the blob), so this pass is cheap
+    urls = []
+    filenames = []
+    for rec in iter_records(run_dir):
+        url = get_record_validation_url(rec, domain)
+        if url:
+            urls.append(url)
+        filenames.append(get_record_filename(rec, ext))
+    qr_version = None
+    if qr_mode == 'vector' and urls:
+        qr_version = fit_qr_version(urls, QR_ERROR_CORRECTION)
+    return filenames, qr_version
+
+def _write_chunks(path, chunks):
+    """Write streamed output under a temporary name, renamed once complete."""
+    with open(path + '.part', 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(path + '.part', path)
+
+def merge_shards(run_dir, svg_template, signature_path, domain, render_mode='layered', qr_mode='vector',
+                 profile=None, pdf=True):
+    """Combine the shards of a run into the run's own manifest, progress, ZIP and PDF.
+
+    Shards already wrote their certificates into the shared output directory;
+    this folds their partial manifests into ``manifest.json`` (the newest
+    shard wins if ranges overlapped), publishes progress and metadata as if
+    one process had rendered the run, and writes ``Certificates.zip`` and
+    ``All_Certificates.<n>.pdf`` (the name the PDF download route caches under).
+    Returns the merged ProgressTracker.
+    """
+    ext = get_profile(profile)['ext']
+    img_out_dir = os.path.join(run_dir, 'certificates')
+    filenames, qr_version = scan_roster(run_dir, domain, ext, qr_mode)
+    shards = sorted(glob.glob(os.path.join(run_dir, SHARDS_DIR, '*')), key=os.path.getmtime)
+
+    manifest = RunManifest(run_dir)
+    for path in shards:
+        manifest.update(RunManifest(run_dir, path=os.path.join(path, MANIFEST_FILE)).entries)
+    manifest.prune(set(filenames))
+    manifest.save(force=True)
+
+    tracker = ProgressTracker(run_dir, len(filenames))
+    for path in shards:
+        progress = read_progress(path) or {}
+        tracker.started_at = min(tracker.started_at, progress.get('updated_at', time.time()) - progress.get('elapsed', 0))
+        tracker.skipped += progress.get('skipped', 0)
+        for stage, entry in progress.get('stages', {}).items():
+            total = tracker.stages.setdefault(stage, {'count': 0, 'total_ms': 0.0})
+            total['count'] += entry['count']
+            total['total_ms'] += entry['total_ms']
+    tracker.start()
+    finished = []
+    missing = 0
+    for filename in filenames:
+        entry = manifest.entries.get(filename)
+        ok = bool(entry and entry['ok'] and os.path.exists(os.path.join(img_out_dir, filename)))
+        missing += entry is None
+        tracker.record(ok, filename)
+        if ok:
+            finished.append(filename)
+    if missing:
+        log.warning("%d records were not rendered by any shard", missing)
+    tracker.finish()
+    log.info("Merged %d shards: %d/%d certificates (%d failed or missing)",
+             len(shards), tracker.done, tracker.total, tracker.failed)
+
+    # Shards on other hosts registered into their own databases: register the whole run here
+    finished_set = set(finished)
+    issue_certificates((rec for rec in iter_records(run_dir) if get_record_filename(rec, ext) in finished_set),
+                       os.path.basename(os.path.normpath(run_dir)))
+    finished.sort()
+    _write_chunks(os.path.join(run_dir, 'Certificates.zip'),
+                  iter_zip((os.path.join(img_out_dir, f), f) for f in finished))
+    if pdf and finished_set:
+        from pdf_export import iter_merged_pdf
+        # Vector pages re-rendered from the records, as in the PDF download route
+        engine = get_engine(svg_template, signature_path, domain, render_mode, qr_mode, qr_version)
+        pages = iter_merged_pdf(
+            engine.iter_svgs(load_records(run_dir), finished_set, open_photo_blob(run_dir), ext),
+            url_fetcher=engine.registry.url_fetcher)
+        _write_chunks(os.path.join(run_dir, f'All_Certificates.{len(finished)}.pdf'), pages)
+    return tracker
 
 def main():
     parser = argparse.ArgumentParser(description='Batch Certificate Generator')
@@ -148,43 +208,134 @@ def main():
     parser.add_argument('--domain', required=True, help='Domain for QR code')
     parser.add_argument('--template', required=True, help='Path to SVG template')
     parser.add_argument('--signature', required=True, help='Path to Signature PNG')
+    parser.add_argument('--render_mode', choices=['layered', 'full'], default='layered',
+                        help='layered: cache static layers per worker; full: rasterize whole SVG per record')
+    parser.add_argument('--qr_mode', choices=['vector', 'raster'], default='vector',
+                        help='vector: inline QR as an SVG path; raster: embed a PNG QR image')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default=DEFAULT_PROFILE,
+                        help='Output profile: format, DPI and encoder settings (see output_profiles.py)')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes (default: available cores)')
+    parser.add_argument('--chunk_size', type=int, default=8, help='Records per task sent to a worker')
+    parser.add_argument('--force', action='store_true',
+                        help='Render every record, even if the run manifest says it is up to date')
+    parser.add_argument('--diagnostics', action='store_true',
+                        help='Profile the workers (cProfile + tracemalloc) into <run_dir>/profile')
+    # Spreading one run over several hosts that share the run directory
+    shard_group = parser.add_mutually_exclusive_group()
+    shard_group.add_argument('--shard', help='Render only shard i of N (1-based, e.g. 2/4) of the records')
+    shard_group.add_argument('--records', help='Render only records START:END (0-based, END exclusive)')
+    shard_group.add_argument('--merge', action='store_true',
+                             help='Combine the finished shards into the run: manifest, progress, ZIP and PDF')
+    parser.add_argument('--no_pdf', action='store_true', help='With --merge: skip the merged PDF')
     
     args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+        record_range = parse_range(args.records) if args.records else None
+    except ValueError as e:
+        parser.error(str(e))
+    setup_logging()
     
-    records_path = os.path.join(args.run_dir, 'records.json')
     img_out_dir = os.path.join(args.run_dir, 'certificates')
     os.makedirs(img_out_dir, exist_ok=True)
-    
-    with open(records_path, 'r') as f:
-        records = json.load(f)
         
     with open(args.template, 'r', encoding='utf-8') as f:
         svg_template = f.read()
+    
+    if args.merge:
+        merge_shards(args.run_dir, svg_template, args.signature, args.domain, args.render_mode,
+                     args.qr_mode, args.profile, pdf=not args.no_pdf)
+        return
         
-    with open(args.signature, "rb") as f:
-        sig_b64 = f"data:image/png;base64,{base64.b64encode(f.read()).decode()}"
+    ext = get_profile(args.profile)['ext']
+    filenames, qr_version = scan_roster(args.run_dir, args.domain, ext, args.qr_mode)
+    start, end = 0, len(filenames)
+    if shard:
+        start, end = shard_range(len(filenames), *shard)
+    elif record_range:
+        start = record_range[0]
+        end = end if record_range[1] is None else min(record_range[1], end)
+        start = min(start, end)
+    state_dir = args.run_dir
+    if shard or record_range:
+        # Deterministic slice of the roster; progress and manifest stay per shard
+        state_dir = shard_dir(args.run_dir, start, end)
+        os.makedirs(state_dir, exist_ok=True)
+    total = end - start
+    run_id = os.path.basename(os.path.normpath(args.run_dir))
+    
+    # Only records that are new, changed or failed last time get rendered
+    if state_dir == args.run_dir:
+        manifest = RunManifest(args.run_dir)
+        manifest.prune(set(filenames))
+    else:
+        manifest = RunManifest(args.run_dir, path=os.path.join(state_dir, MANIFEST_FILE))
+        if not manifest.entries:
+            # First pass of this shard over a run rendered (and merged) before
+            shard_files = set(filenames[start:end])
+            manifest.update({f: e for f, e in RunManifest(args.run_dir).entries.items() if f in shard_files})
+        # No pruning here: files outside this slice belong to other shards
+    del filenames
+    key = run_settings_key(svg_template, args.signature, args.domain, args.render_mode,
+                           args.qr_mode, qr_version, args.profile)
         
-    print(f"Starting batch generation for {len(records)} records...")
+    if state_dir == args.run_dir:
+        log.info("Starting batch generation for %d records...", total)
+    else:
+        log.info("Starting batch generation for records %d-%d (%d records)...", start, end, total)
+    tracker = ProgressTracker(state_dir, total)
+    tracker.start()
+    
+    def pending():
+        records = itertools.islice(iter_records(args.run_dir), start, end)
+        for rec, filename, fingerprint, up_to_date in plan_records(
+                records, manifest, key, ext, open_photo_blob(args.run_dir), args.force):
+            if up_to_date:
+                tracker.record(True, filename, skipped=True)
+            else:
+                yield rec, filename, fingerprint
+    
+    workers = args.workers or default_worker_count()
+    chunk_size = max(1, args.chunk_size)
+    window = workers * 2 # chunks in flight: keeps workers busy without queueing the roster
+    log.info("Using %d workers, %d records per chunk", workers, chunk_size)
     
     # Process Pool for GDI safety/speed
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        futures = []
-        for rec in records:
-            futures.append(executor.submit(
-                generate_single_certificate,
-                rec,
-                svg_template,
-                sig_b64,
-                img_out_dir,
-                args.domain
-            ))
-            
-        completed = 0
-        for future in concurrent.futures.as_completed(futures):
-            if future.result():
-                completed += 1
-            if completed % 10 == 0:
-                print(f"Generated {completed}/{len(records)}")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(svg_template, args.signature, args.run_dir, args.domain,
+                  args.render_mode, args.qr_mode, qr_version, args.profile, args.diagnostics)
+    ) as executor:
+        chunks = iter_chunks(pending(), chunk_size)
+        inflight = {}
+        while True:
+            for chunk in chunks:
+                inflight[executor.submit(_render_chunk, [rec for rec, _, _ in chunk])] = chunk
+                if len(inflight) >= window:
+                    break
+            if not inflight:
+                break
+            done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk = inflight.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    log.error("Worker failed: %s", e)
+                    results = [{'ok': False}] * len(chunk)
+                for (_, filename, fingerprint), result in zip(chunk, results):
+                    manifest.mark(filename, fingerprint, result['ok'])
+                    tracker.record(result['ok'], result.get('filename'), result.get('timings'))
+                # One registry transaction per chunk; the QR codes resolve from now on
+                issue_certificates([rec for (rec, _, _), result in zip(chunk, results) if result['ok']], run_id)
+    
+    manifest.save(force=True)
+    tracker.finish()
+    # No scraper for a one-off CLI run: leave the stage histograms next to the outputs
+    with open(os.path.join(state_dir, 'metrics.prom'), 'w') as f:
+        f.write(REGISTRY.render())
+    log.info("Generated %d/%d (%d up to date, %d failed)", tracker.done, total, tracker.skipped, tracker.failed)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,400 @@
+"""Stage-level throughput benchmark on synthetic rosters.
+
+Each stage of the pipeline is timed on its own, for every roster size (and
+worker count for the end-to-end batch):
+
+    ingest       SmartIngestor.process_data_file (csv / xlsx / pdf)
+    photos       SmartIngestor.process_images on a synthetic photo ZIP
+    records      get_records + run_store.write_run
+    stream       SmartIngestor.iter_record_batches + write_run (parse, match and store per batch)
+    qr           vector QR path fields for the whole roster
+    format       RenderEngine.prepare + template formatting
+    rasterize    layered render (and full cairosvg render) of a sample
+    encode       output-profile encode + file write of the sample
+    zip          streaming ZIP of the written certificates
+    pdf          merged vector PDF of the sample
+    batch        batch_processor.py end to end, per worker count
+    startup      web app cold start and forked-worker memory, lazy vs preloaded
+
+Results (records/sec and peak RSS per stage) are written as JSON; pass
+``--compare`` an earlier results file to print the change per stage.
+
+    python benchmark.py --rows 200,1000 --workers 1,2,4 --out bench_results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import synthetic_data
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(APP_DIR, 'templates', 'certificate_template.svg')
+SIGNATURE_PATH = os.path.join(APP_DIR, 'signature.png')
+DOMAIN = 'https://certificates.example.org'
+
+
+def _read_status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS mark (Linux) so each stage gets its own peak."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb(children=False):
+    if children:
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    kb = _read_status_kb('VmHWM')
+    if kb is None and resource is not None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            kb /= 1024.0
+    return kb / 1024.0 if kb is not None else None
+
+
+class Bench:
+    def __init__(self, quiet=True):
+        self.results = []
+        self.quiet = quiet
+
+    @contextlib.contextmanager
+    def stage(self, name, count, **labels):
+        """Time the block as one stage over ``count`` records.
+
+        The block may override ``count``, ``seconds`` or ``peak_rss_mb`` in the
+        yielded labels, and add measurements under ``details``.
+        """
+        reset_peak_rss()
+        sink = io.StringIO()
+        redirect = contextlib.redirect_stdout(sink) if self.quiet else contextlib.nullcontext()
+        start = time.perf_counter()
+        with redirect:
+            yield labels
+        seconds = labels.pop('seconds', None) or time.perf_counter() - start
+        n = labels.pop('count', count)
+        rss = labels.pop('peak_rss_mb', None) or _round(peak_rss_mb())
+        details = labels.pop('details', None)
+        result = {
+            'stage': name,
+            **labels,
+            'records': n,
+            'seconds': round(seconds, 4),
+            'records_per_sec': round(n / seconds, 2) if seconds > 0 else None,
+            'peak_rss_mb': rss,
+        }
+        if details:
+            result['details'] = details
+        self.results.append(result)
+        print(f"{name:<10} {json.dumps(labels):<36} {n:>6} rec  {seconds:8.3f}s  "
+              f"{result['records_per_sec'] or 0:10.1f} rec/s  {result['peak_rss_mb'] or 0:8.1f} MB")
+        if details:
+            print(f"           {json.dumps(details)}")
+
+
+def _round(value):
+    return round(value, 1) if value is not None else None
+
+
+def bench_roster(bench, rows, args, work_dir):
+    from smart_ingestion import SmartIngestor
+
+    roster = synthetic_data.synthetic_roster(rows, args.names, args.seed)
+    files = {}
+    for fmt in args.formats:
+        try:
+            files[fmt] = synthetic_data.WRITERS[fmt](os.path.join(work_dir, f"roster.{fmt}"), roster)
+        except Exception as e:
+            print(f"Skipping {fmt} roster: {e}")
+    zip_path = synthetic_data.write_photo_zip(os.path.join(work_dir, 'photos.zip'), roster,
+                                              args.photo_size, args.coverage, seed=args.seed)
+
+    from render_engine import load_template, photo_slot
+    slot = photo_slot(load_template(TEMPLATE_PATH))
+    ingestor = None
+    for fmt, path in files.items():
+        candidate = SmartIngestor(photo_slot=slot)
+        with bench.stage('ingest', rows, rows=rows, format=fmt):
+            ok, msg = candidate.process_data_file(path)
+        if ok and ingestor is None:
+            ingestor = candidate
+    if ingestor is None:
+        raise RuntimeError("No roster format could be ingested")
+
+    with bench.stage('photos', rows, rows=rows, photo_size='x'.join(map(str, args.photo_size))):
+        ingestor.process_images(zip_path=zip_path)
+
+    run_dir = os.path.join(work_dir, 'run')
+    os.makedirs(os.path.join(run_dir, 'certificates'), exist_ok=True)
+    from run_store import write_run
+    with bench.stage('records', rows, rows=rows):
+        records = ingestor.get_records()
+        write_run(run_dir, ingestor.iter_records())
+    # The upload path: nothing but the current batch is held in memory
+    stream_dir = os.path.join(work_dir, 'stream')
+    os.makedirs(stream_dir, exist_ok=True)
+    roster_path = files.get('csv') or next(iter(files.values()))
+    with bench.stage('stream', rows, rows=rows, format=os.path.splitext(roster_path)[1].lstrip('.')):
+        batches = SmartIngestor(photo_slot=slot).iter_record_batches(roster_path, zip_path=zip_path)
+        write_run(stream_dir, (item for batch in batches for item in batch))
+    with open(os.path.join(run_dir, 'metadata.json'), 'w') as f:
+        json.dump({'total': rows, 'status': 'processing', 'domain': DOMAIN}, f)
+
+    bench_render_stages(bench, rows, records, run_dir, args)
+    for workers in args.workers:
+        bench_batch(bench, rows, workers, run_dir, args)
+
+
+def bench_render_stages(bench, rows, records, run_dir, args):
+    from asset_registry import AssetRegistry
+    from layer_cache import get_layered_renderer, svg_to_image
+    from output_profiles import encode_image, get_profile, profile_scale
+    from qr_vector import qr_matrix, qr_path_fields, vectorize_qr_template
+    from render_engine import (QR_BORDER, QR_ERROR_CORRECTION, RenderEngine, fit_roster_qr_version,
+                               get_cert_id, get_validation_url, load_template)
+    from run_store import load_records, open_photo_blob
+
+    svg_template = load_template(TEMPLATE_PATH)
+    vector_template, qr_size = vectorize_qr_template(svg_template)
+    urls = [get_validation_url(get_cert_id(rec), DOMAIN) for rec in records]
+
+    with bench.stage('qr', rows, rows=rows):
+        qr_matrix.cache_clear()
+        qr_path_fields.cache_clear()
+        version = fit_roster_qr_version(records, DOMAIN)
+        for url in urls:
+            qr_path_fields(url, qr_size, QR_ERROR_CORRECTION, QR_BORDER, version)
+
+    registry = AssetRegistry()
+    sig_ref = registry.put_file(SIGNATURE_PATH, key='signature')
+    engine = RenderEngine(svg_template, SIGNATURE_PATH, DOMAIN, 'layered', 'vector', version, registry)
+    compact = load_records(run_dir)
+    photos = open_photo_blob(run_dir)
+    with bench.stage('format', rows, rows=rows):
+        prepared = []
+        for rec in compact:
+            fields, filename, refs = engine.prepare(rec, photos=photos)
+            engine.format_svg(fields)
+            prepared.append((fields, filename, refs))
+
+    sample = prepared[:args.render_sample]
+    out_dir = os.path.join(run_dir, 'bench_out')
+    os.makedirs(out_dir, exist_ok=True)
+    for profile_name in args.profiles:
+        profile = get_profile(profile_name)
+        if profile['format'] == 'PDF':
+            continue
+        renderer = get_layered_renderer(vector_template, registry, profile_scale(profile), signature_base64=sig_ref)
+        with bench.stage('rasterize', len(sample), rows=rows, mode='layered', profile=profile_name):
+            images = [(renderer.render(**fields), filename) for fields, filename, _ in sample]
+        with bench.stage('encode', len(sample), rows=rows, profile=profile_name):
+            for img, filename in images:
+                path = os.path.join(out_dir, os.path.splitext(filename)[0] + profile['ext'])
+                with open(path, 'wb') as f:
+                    f.write(encode_image(img, profile))
+        del images
+    if args.full_render:
+        full = sample[:max(1, len(sample) // 4)]
+        with bench.stage('rasterize', len(full), rows=rows, mode='full', profile='print'):
+            for fields, _, _ in full:
+                svg_to_image(engine.format_svg(fields), url_fetcher=registry.url_fetcher)
+
+    from zip_stream import iter_zip_dir
+    count = len(os.listdir(out_dir))
+    with bench.stage('zip', count, rows=rows):
+        size = sum(len(chunk) for chunk in iter_zip_dir(out_dir))
+    print(f"           zip size {size / 1e6:.1f} MB")
+
+    from pdf_export import iter_merged_pdf
+    with bench.stage('pdf', len(sample), rows=rows):
+        pages = (engine.format_svg(fields) for fields, _, _ in sample)
+        size = sum(len(chunk) for chunk in iter_merged_pdf(pages, registry.url_fetcher))
+    print(f"           pdf size {size / 1e6:.1f} MB")
+
+    for _, _, refs in prepared:
+        engine.release(refs)
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def bench_batch(bench, rows, workers, run_dir, args):
+    cert_dir = os.path.join(run_dir, 'certificates')
+    shutil.rmtree(cert_dir, ignore_errors=True)
+    os.makedirs(cert_dir)
+    cmd = [
+        sys.executable, os.path.join(APP_DIR, 'batch_processor.py'),
+        '--run_dir', run_dir, '--domain', DOMAIN,
+        '--template', TEMPLATE_PATH, '--signature', SIGNATURE_PATH,
+        '--profile', args.profiles[0], '--workers', str(workers), '--force',
+    ]
+    # Cold render cache, otherwise later worker counts would only copy files; synthetic
+    # certificates go to a throwaway registry, never the real certificates.db
+    env = dict(os.environ, RENDER_CACHE_MAX_MB='0', CERT_REGISTRY_PATH=os.path.join(run_dir, 'certificates.db'))
+    with bench.stage('batch', rows, rows=rows, workers=workers, profile=args.profiles[0]) as labels:
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # Largest single child process so far (the kernel keeps no per-run reset)
+        labels['peak_rss_mb'] = _round(peak_rss_mb(children=True))
+    if proc.returncode != 0:
+        print(proc.stdout[-2000:])
+        raise RuntimeError(f"batch_processor exited with {proc.returncode}")
+
+
+# Runs in a fresh interpreter: imports the app like a gunicorn master would,
+# forks one "worker" that loads the render stack, and reports both processes.
+STARTUP_PROBE = r'''
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[2])
+import app
+from metrics import process_memory
+imported = time.perf_counter() - started
+if sys.argv[1] == 'preload':
+    app.preload_assets()
+    import gc
+    gc.freeze()
+ready = time.perf_counter() - started
+read_fd, write_fd = os.pipe()
+pid = os.fork()
+if pid == 0:
+    first = time.perf_counter()
+    if sys.argv[1] == 'lazy':
+        app.preload_assets()  # what a lazy worker loads on its first upload
+    app.app.test_client().get('/')
+    worker = dict(process_memory(), first_request_seconds=time.perf_counter() - first)
+    os.write(write_fd, json.dumps(worker).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+worker = json.loads(os.read(read_fd, 65536))
+print(json.dumps({'import_seconds': imported, 'ready_seconds': ready,
+                  'master': process_memory(), 'worker': worker}))
+'''
+
+
+def bench_startup(bench, args):
+    if not hasattr(os, 'fork'):
+        print("Skipping startup: needs fork()")
+        return
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    for mode in ('lazy', 'preload'):
+        with bench.stage('startup', 1, mode=mode) as labels:
+            proc = subprocess.run([sys.executable, '-c', STARTUP_PROBE, mode, APP_DIR], env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                print(proc.stderr[-2000:])
+                raise RuntimeError(f"startup probe exited with {proc.returncode}")
+            probe = json.loads(proc.stdout.strip().splitlines()[-1])
+            worker = probe['worker']
+            labels['seconds'] = probe['ready_seconds']
+            # RSS counts shared pages in full; the worker's own cost is its pss/uss
+            labels['peak_rss_mb'] = _round(worker['rss'] / 1e6) if worker.get('rss') else None
+            labels['details'] = {
+                'import_seconds': round(probe['import_seconds'], 3),
+                'worker_first_request_seconds': round(worker['first_request_seconds'], 3),
+                'worker_rss_mb': _round(worker.get('rss', 0) / 1e6),
+                'worker_pss_mb': _round(worker.get('pss', 0) / 1e6),
+                'worker_uss_mb': _round(worker.get('uss', 0) / 1e6),
+                'master_rss_mb': _round(probe['master'].get('rss', 0) / 1e6),
+            }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.time(),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def result_key(result):
+    return json.dumps({k: v for k, v in result.items()
+                       if k not in ('records', 'seconds', 'records_per_sec', 'peak_rss_mb', 'details')},
+                      sort_keys=True)
+
+
+def compare(old_path, results):
+    with open(old_path, 'r') as f:
+        old = {result_key(r): r for r in json.load(f)['results']}
+    print(f"\n--- Change vs {old_path} (records/sec, peak RSS) ---")
+    for result in results:
+        before = old.get(result_key(result))
+        if not before or not before.get('records_per_sec') or not result.get('records_per_sec'):
+            continue
+        speed = result['records_per_sec'] / before['records_per_sec'] - 1
+        rss = ''
+        if before.get('peak_rss_mb') and result.get('peak_rss_mb'):
+            rss = f"{result['peak_rss_mb'] - before['peak_rss_mb']:+8.1f} MB"
+        print(f"{result_key(result):<80} {speed:+8.1%} {rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Certificate pipeline benchmark')
+    parser.add_argument('--rows', default='200', help='Comma-separated roster sizes')
+    parser.add_argument('--workers', default='1,2,4', help='Comma-separated batch worker counts (empty: skip)')
+    parser.add_argument('--formats', default='csv,xlsx,pdf', help='Roster formats to ingest')
+    parser.add_argument('--names', default='mixed', help='Name length distribution (see synthetic_data.py)')
+    parser.add_argument('--photo_size', default='600x800', type=synthetic_data.parse_size)
+    parser.add_argument('--coverage', type=float, default=1.0, help='Fraction of students with a photo')
+    parser.add_argument('--profiles', default='print,web', help='Output profiles for render/encode stages')
+    parser.add_argument('--render_sample', type=int, default=50, help='Records rendered per profile')
+    parser.add_argument('--full_render', action='store_true', help='Also time whole-SVG cairosvg rendering')
+    parser.add_argument('--no_startup', action='store_true', help='Skip the web app startup stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', help='Earlier results file to diff against')
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    args = parser.parse_args()
+    args.formats = [f for f in args.formats.split(',') if f]
+    args.profiles = [p for p in args.profiles.split(',') if p]
+    args.workers = [int(w) for w in args.workers.split(',') if w]
+
+    bench = Bench(quiet=not args.verbose)
+    if not args.no_startup:
+        bench_startup(bench, args)
+    for rows in [int(r) for r in args.rows.split(',')]:
+        work_dir = tempfile.mkdtemp(prefix=f'certbench_{rows}_')
+        try:
+            bench_roster(bench, rows, args, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'args': sys.argv[1:], 'results': bench.results}, f, indent=2)
+    print(f"Wrote {args.out}")
+    if args.compare:
+        compare(args.compare, bench.results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Registry of issued certificates behind the QR codes' ``/validate/<cert_id>`` URLs.
+
+Runs (batch_processor, the render service) record each successfully
+rendered certificate here, and the web app looks cert_ids up when a QR code
+is scanned. A cert_id is issued once: later runs cannot change its name.
+
+- Storage: one SQLite table keyed by cert_id (primary key, so a lookup is a
+  single index probe), in WAL mode so scans never wait on a run being
+  written and several processes can issue at once.
+- Caching: each process keeps recent lookups in a small LRU with a TTL
+  (shorter for unknown ids), so scan bursts mostly skip the database.
+
+``CERT_REGISTRY_PATH`` moves the database (default: ``certificates.db`` next
+to this file). WAL needs a local filesystem; hosts rendering shards of one
+run should each use a local path, and the host running the merge step
+registers the whole run.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from logs import get_logger
+
+log = get_logger('registry')
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'certificates.db')
+CACHE_SIZE = 4096
+CACHE_TTL = 300  # seconds a found certificate is served from memory (and by HTTP caches)
+MISS_TTL = 30    # unknown ids are re-checked sooner: their run may still be rendering
+
+COLUMNS = ('cert_id', 'name', 'roll', 'date', 'run_id', 'issued_at')
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificates (
+    cert_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    roll TEXT NOT NULL,
+    date TEXT,
+    run_id TEXT,
+    issued_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+
+class CertRegistry:
+    def __init__(self, path=None, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, miss_ttl=MISS_TTL):
+        self.path = path or os.environ.get('CERT_REGISTRY_PATH') or DEFAULT_PATH
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.miss_ttl = miss_ttl
+        self._cache = OrderedDict()  # cert_id -> (entry or None, expires_at)
+        self._lock = threading.Lock()
+        self._local = threading.local()  # one connection per thread
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not cross a fork (gunicorn preload, process pools)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def issue(self, entries, run_id=None):
+        """Record certificates ({'cert_id', 'name', 'roll', 'date'}) as issued; returns the new count.
+
+        An issued certificate is never overwritten: re-issuing it with the same
+        name (a resumed or re-rendered run) is a no-op, and a different name
+        under an existing cert_id is refused and logged.
+        """
+        now = time.time()
+        rows = [(e['cert_id'], e['name'], e['roll'], e.get('date'), run_id, now) for e in entries]
+        if not rows:
+            return 0
+        issued = []
+        conn = self._connect()
+        with conn:
+            for row in rows:
+                cursor = conn.execute('INSERT INTO certificates VALUES (?, ?, ?, ?, ?, ?) '
+                                      'ON CONFLICT(cert_id) DO NOTHING', row)
+                if cursor.rowcount:
+                    issued.append(row[0])
+                    continue
+                existing = conn.execute('SELECT name FROM certificates WHERE cert_id = ?', (row[0],)).fetchone()
+                if existing and existing[0] != row[1]:
+                    log.warning("Refusing to re-issue %s to %r: already issued to %r", row[0], row[1], existing[0])
+        with self._lock:
+            for cert_id in issued:
+                self._cache.pop(cert_id, None)
+        return len(issued)
+
+    def lookup(self, cert_id):
+        """(entry dict or None, cached) for ``cert_id``."""
+        now = time.monotonic()
+        with self._lock:
+            hit = self._cache.get(cert_id)
+            if hit and hit[1] > now:
+                self._cache.move_to_end(cert_id)
+                return hit[0], True
+        row = self._connect().execute(
+            'SELECT %s FROM certificates WHERE cert_id = ?' % ', '.join(COLUMNS), (cert_id,)).fetchone()
+        entry = dict(zip(COLUMNS, row)) if row else None
+        with self._lock:
+            self._cache[cert_id] = (entry, now + (self.cache_ttl if entry else self.miss_ttl))
+            self._cache.move_to_end(cert_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry, False
+
+
+_REGISTRY = None
+
+
+def get_cert_registry():
+    """Process-wide registry."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = CertRegistry()
+    return _REGISTRY
+
+
+def issue_certificates(records, run_id=None):
+    """Register rendered roster records; registry errors are logged, never raised."""
+    # Only called where certificates are rendered, so the render stack is already loaded
+    from render_engine import certificate_entry, has_cert_id
+    try:
+        return get_cert_registry().issue([certificate_entry(rec) for rec in records if has_cert_id(rec)], run_id)
+    except sqlite3.Error as e:
+        log.warning("Could not register issued certificates: %s", e)
+        return 0
@@ -0,0 +1,79 @@
+"""Gunicorn settings: load the app once in the master and fork warm workers.
+
+With ``preload_app`` the master imports the app and runs
+``app.preload_assets()`` before forking, so every worker shares the
+imported modules, template, signature and static certificate layers
+copy-on-write. ``PRELOAD_APP=0`` goes back to importing the app in each
+worker (heavy modules then load on the first request that needs them).
+Either way the master then starts the render service's own process.
+
+Requests are served by threads (``gthread``): progress SSE feeds, the
+NDJSON bulk API and ZIP/PDF downloads hold a request open for minutes,
+which would monopolise a sync worker and get it killed at ``timeout``
+together with its render pool. With threads the timeout only bounds a
+worker that stops heartbeating. ``WEB_THREADS`` sets threads per worker;
+at most ``SSE_MAX_STREAMS`` of them serve progress streams (see app.py).
+
+Bind address and worker count come from gunicorn's usual ``PORT`` /
+``WEB_CONCURRENCY`` environment variables.
+"""
+import gc
+import os
+import shutil
+
+from logs import setup_logging
+
+# The master (which imports the preloaded app next) logs with direct writes and
+# no listener thread, so it has no threads of ours when it forks
+setup_logging(threaded=False)
+
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0'
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+timeout = 120
+# Streams end on their own (SSE reconnects every few minutes); give them time on restart
+graceful_timeout = 60
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+_render_server = None
+
+
+def when_ready(server):
+    global _render_server
+    if preload_app:
+        from app import preload_assets
+        preload_assets()
+        # Keep the collector from walking (and so un-sharing) everything loaded so far
+        gc.freeze()
+    # One render service for all workers (forked from the warm master), so the
+    # render limit, run state and queued runs survive worker restarts
+    # Paths as in app.py, without importing the app when PRELOAD_APP=0
+    from render_service import start_render_server
+    if _render_server is not None:
+        _render_server.shutdown()
+    _render_server = start_render_server(os.path.join(ROOT, 'templates', 'certificate_template.svg'),
+                                         os.path.join(ROOT, 'signature.png'))
+
+
+def on_exit(server):
+    global _render_server
+    if _render_server is not None:
+        _render_server.shutdown()
+        # The socket's private directory (see start_render_server)
+        shutil.rmtree(os.path.dirname(_render_server.address), ignore_errors=True)
+        _render_server = None
+
+
+def post_fork(server, worker):
+    import multiprocessing.process
+    # The render server is the master's child: a worker must not try to join it at exit
+    multiprocessing.process._children.clear()
+    # Workers log through their own queue and listener thread
+    setup_logging()
+
+
+def post_worker_init(worker):
+    from logs import get_logger
+    from metrics import memory_summary
+    get_logger('gunicorn').info("Worker %s ready: %s", worker.pid, memory_summary())
@@ -0,0 +1,191 @@
+"""Static-layer raster cache for the certificate template.
+
+The template is split into a static layer (background, borders, ID card body,
+fixed text and the signature) and an overlay holding only the elements that
+reference per-record fields. The static layer is rasterized once per template
+and each certificate only rasterizes the overlay and composites it on top.
+
+Per-record ``<image>`` elements whose href is a single field (photo, QR) are
+not handed to cairosvg at all: they become "slots" that are filled by pasting
+the already decoded image from the asset registry.
+"""
+import re
+from io import BytesIO
+
+from PIL import Image
+from cairosvg.parser import Tree
+from cairosvg.surface import PNGSurface
+
+from asset_registry import get_registry
+
+# Fields that are the same on every certificate of a run (baked into the base)
+STATIC_FIELDS = ('signature_base64',)
+
+# Leaf drawing elements of the template (everything except groups/defs)
+_LEAF_RE = re.compile(
+    r'<text\b[^>]*>.*?</text>'
+    r'|<(?:rect|line|image|path|circle|ellipse|polygon|polyline|svg)\b[^>]*/>',
+    re.S
+)
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+_FIELD_RE = re.compile(r'\{(\w+)\}')
+_SLOT_TOKEN_RE = re.compile(r'<g\b[^>]*>|</g>|<image\b[^>]*/>')
+_TRANSLATE_RE = re.compile(r'^\s*translate\(\s*([-\d.]+)[\s,]+([-\d.]+)\s*\)\s*$')
+_ALIGN = {'min': 0.0, 'mid': 0.5, 'max': 1.0}
+
+
+def _attr(element, name, default=None):
+    match = re.search(r'\s%s="([^"]*)"' % re.escape(name), element)
+    return match.group(1) if match else default
+
+
+def extract_image_slots(overlay_svg):
+    """Pull single-field <image> elements out of the overlay.
+
+    Returns (overlay_svg_without_slots, slots). Each slot is a dict with the
+    field name, absolute pixel box and preserveAspectRatio fit/alignment.
+    Images under anything other than a plain translate() are left to cairosvg.
+    """
+    slots = []
+    offsets = [(0.0, 0.0, True)]
+    kept = []
+    pos = 0
+    for match in _SLOT_TOKEN_RE.finditer(overlay_svg):
+        token = match.group(0)
+        if token.startswith('</g'):
+            if len(offsets) > 1:
+                offsets.pop()
+            continue
+        if token.startswith('<g'):
+            ox, oy, ok = offsets[-1]
+            transform = _attr(token, 'transform')
+            if transform:
+                tm = _TRANSLATE_RE.match(transform)
+                if tm:
+                    ox, oy = ox + float(tm.group(1)), oy + float(tm.group(2))
+                else:
+                    ok = False
+            offsets.append((ox, oy, ok))
+            continue
+        href = _attr(token, 'href') or _attr(token, 'xlink:href') or ''
+        field = re.fullmatch(r'\{(\w+)\}', href)
+        ox, oy, ok = offsets[-1]
+        if not (field and ok and _attr(token, 'width') and _attr(token, 'height')):
+            continue
+        aspect = (_attr(token, 'preserveAspectRatio') or 'xMidYMid meet').split()
+        align = aspect[0]
+        if align == 'none':
+            fit, centering = 'none', (0.5, 0.5)
+        else:
+            fit = aspect[1] if len(aspect) > 1 else 'meet'
+            centering = (_ALIGN[align[1:4].lower()], _ALIGN[align[5:8].lower()])
+        slots.append({
+            'field': field.group(1),
+            'x': int(round(ox + float(_attr(token, 'x', 0)))),
+            'y': int(round(oy + float(_attr(token, 'y', 0)))),
+            'width': int(round(float(_attr(token, 'width')))),
+            'height': int(round(float(_attr(token, 'height')))),
+            'fit': fit,
+            'align': centering,
+        })
+        kept.append(overlay_svg[pos:match.start()])
+        pos = match.end()
+    kept.append(overlay_svg[pos:])
+    return ''.join(kept), slots
+
+
+def split_template(svg_template, static_fields=STATIC_FIELDS):
+    """Split template into (static_svg, overlay_svg).
+
+    Both keep the root <svg>, <defs> and <g> structure so transforms still
+    apply; each only keeps its own leaf elements.
+    """
+    head, sep, body = svg_template.partition('</defs>')
+    if not sep:
+        head, body = '', svg_template
+    body = _COMMENT_RE.sub('', body)
+
+    def is_dynamic(element):
+        return any(f not in static_fields for f in _FIELD_RE.findall(element))
+
+    static_body = _LEAF_RE.sub(lambda m: '' if is_dynamic(m.group(0)) else m.group(0), body)
+    overlay_body = _LEAF_RE.sub(lambda m: m.group(0) if is_dynamic(m.group(0)) else '', body)
+    return head + sep + static_body, head + sep + overlay_body
+
+
+def svg_to_image(svg_data, scale=1, **tree_kwargs):
+    """Rasterize SVG markup straight to a PIL RGBA image (no PNG round-trip)."""
+    tree = Tree(bytestring=svg_data.encode('utf-8'), **tree_kwargs)
+    surface = PNGSurface(tree, None, 96, scale=scale)
+    cairo_surface = surface.cairo
+    cairo_surface.flush()
+    # Cairo ARGB32 is premultiplied, native-endian (BGRA byte order on x86/ARM)
+    return Image.frombuffer(
+        'RGBA',
+        (cairo_surface.get_width(), cairo_surface.get_height()),
+        bytes(cairo_surface.get_data()),
+        'raw', 'BGRa', cairo_surface.get_stride(), 1
+    )
+
+
+class LayeredRenderer:
+    """Render certificates as cached static base + per-record overlay."""
+
+    def __init__(self, svg_template, static_values, registry=None, scale=1):
+        self.registry = registry or get_registry()
+        self.scale = scale
+        static_svg, overlay_svg = split_template(svg_template, tuple(static_values))
+        self.overlay_template, self.slots = extract_image_slots(overlay_svg)
+        self.static_values = dict(static_values)
+        self.base = svg_to_image(
+            static_svg.format(**static_values), scale, url_fetcher=self.registry.url_fetcher
+        ).convert('RGB')
+
+    def _paste_slots(self, img, fields):
+        for slot in self.slots:
+            ref = self.registry.resolve(fields.get(slot['field'], ''))
+            if not ref:
+                continue
+            # Slots are in template units; the base is rendered at self.scale
+            w = max(1, int(round(slot['width'] * self.scale)))
+            h = max(1, int(round(slot['height'] * self.scale)))
+            picture = self.registry.get_fitted(ref, w, h, slot['fit'], slot['align'])
+            ax, ay = slot['align']
+            x = int(round(slot['x'] * self.scale)) + int(round((w - picture.width) * ax))
+            y = int(round(slot['y'] * self.scale)) + int(round((h - picture.height) * ay))
+            img.paste(picture, (x, y), picture if picture.mode == 'RGBA' else None)
+
+    def render(self, **fields):
+        """Return the composited certificate as a PIL RGB image."""
+        img = self.base.copy()
+        self._paste_slots(img, fields)
+        overlay = svg_to_image(
+            self.overlay_template.format(**self.static_values, **fields),
+            self.scale, url_fetcher=self.registry.url_fetcher
+        )
+        bbox = overlay.getchannel('A').getbbox()
+        if bbox:
+            region = overlay.crop(bbox)
+            img.paste(region, bbox[:2], region)
+        return img
+
+    def render_png(self, **fields):
+        buf = BytesIO()
+        self.render(**fields).save(buf, format='PNG')
+        return buf.getvalue()
+
+
+_RENDERERS = {}
+
+
+def get_layered_renderer(svg_template, registry=None, scale=1, **static_values):
+    """Per-process memo so each worker rasterizes the static layer only once."""
+    # The renderer keeps its registry alive, so id(registry) cannot be reused while memoized
+    key = (svg_template, scale, tuple(sorted(static_values.items())), id(registry))
+    renderer = _RENDERERS.get(key)
+    if renderer is None:
+        if len(_RENDERERS) >= 4:
+            _RENDERERS.clear()
+        renderer = LayeredRenderer(svg_template, static_values, registry, scale)
+        _RENDERERS[key] = renderer
+    return renderer
@@ -0,0 +1,55 @@
+"""Non-blocking logging for the app, the render service and batch workers.
+
+Log calls only put the record on an in-memory queue; a listener thread
+does the formatting and the console / ``error.log`` writes, so request and
+render threads never wait on disk. Errors (with tracebacks) go to
+``error.log`` as before; everything at ``LOG_LEVEL`` (default INFO) goes to
+the console.
+
+Call ``setup_logging()`` once per process, including in pool initializers:
+a forked worker gets a fresh queue and listener of its own. A process that
+is about to fork (the gunicorn master) uses ``setup_logging(threaded=False)``
+instead, which writes directly and starts no thread.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOGGER_NAME = 'certgen'
+
+_LISTENER = None
+_CONFIGURED_PID = None
+
+
+def setup_logging(level=None, error_log='error.log', threaded=True):
+    global _LISTENER, _CONFIGURED_PID
+    # Handlers inherited through fork are reconfigured: a listener has no thread here
+    if _CONFIGURED_PID == os.getpid():
+        return
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    errors = logging.FileHandler(error_log, delay=True)
+    errors.setLevel(logging.ERROR)
+    errors.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s\n' + '-' * 50))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    _CONFIGURED_PID = os.getpid()
+    if not threaded:
+        logger.handlers = [console, errors]
+        return
+
+    log_queue = queue.SimpleQueue()
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _LISTENER = logging.handlers.QueueListener(log_queue, console, errors, respect_handler_level=True)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
+
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
@@ -0,0 +1,288 @@
+"""In-process metrics with Prometheus text exposition, plus opt-in run profiling.
+
+Counters and histograms live in one process-wide registry and are served
+by the app at ``/metrics``. Render stage timings come back from the pool
+worker processes with every result (see ProgressTracker.record), so they
+are counted in whichever process runs the render service. Under gunicorn
+that is the dedicated render server: its RENDER_METRICS are fetched through
+the service proxy (RenderService.metrics) and appended by ``/metrics``.
+
+RunProfiler captures cProfile and tracemalloc data over many calls, for
+runs submitted with diagnostics enabled.
+"""
+import cProfile
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        return [f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self, names=None, exclude=()):
+        """Prometheus text exposition format (version 0.0.4).
+
+        ``names`` limits the output to those metrics; ``exclude`` leaves some out.
+        """
+        with self._lock:
+            metrics = sorted((m for m in self._metrics.values()
+                              if (names is None or m.name in names) and m.name not in exclude),
+                             key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'certgen_http_requests', 'HTTP requests handled.', ('route', 'method', 'status'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'certgen_http_request_seconds', 'HTTP request latency (until the response is returned).', ('route',))
+INGEST_STAGE_SECONDS = REGISTRY.histogram(
+    'certgen_ingest_stage_seconds', 'Roster ingestion stage latency.', ('stage',))
+PHOTOS = REGISTRY.counter(
+    'certgen_photos', 'Roster rows by photo match result.', ('result',))
+RENDER_STAGE_SECONDS = REGISTRY.histogram(
+    'certgen_render_stage_seconds', 'Per-certificate render stage latency.', ('stage',))
+CERTIFICATES = REGISTRY.counter(
+    'certgen_certificates', 'Certificates by outcome.', ('result',))
+RUNS = REGISTRY.counter(
+    'certgen_runs', 'Finished runs by final status.', ('status',))
+# Recorded by the render service, which may run in its own process
+RENDER_METRICS = (RENDER_STAGE_SECONDS.name, CERTIFICATES.name, RUNS.name)
+VALIDATIONS = REGISTRY.counter(
+    'certgen_validations', 'Certificate validation lookups by result and source (cache or database).',
+    ('result', 'source'))
+STARTUP_SECONDS = REGISTRY.gauge(
+    'certgen_startup_seconds', 'Time spent importing the app and preloading shared assets.', ('phase',))
+PROCESS_MEMORY = REGISTRY.gauge(
+    'certgen_process_memory_bytes', 'Memory of this process (rss, pss, uss), sampled on scrape.', ('kind',))
+
+
+def process_memory():
+    """{'rss', 'pss', 'uss'} in bytes for this process ({} where /proc is unavailable).
+
+    PSS splits shared pages between the processes sharing them and USS counts
+    only private pages, so for forked workers they show what copy-on-write
+    sharing actually saves; RSS counts every shared page in full.
+    """
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                field, _, rest = line.partition(':')
+                if field in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    values[field] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError):
+        return {}
+    return {'rss': values.get('Rss', 0), 'pss': values.get('Pss', 0),
+            'uss': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)}
+
+
+def memory_summary():
+    """process_memory() as a log-friendly string."""
+    memory = process_memory()
+    return ', '.join(f"{kind} {value / 1e6:.1f} MB" for kind, value in memory.items()) or 'memory n/a'
+
+
+def sample_process_memory():
+    memory = process_memory()
+    for kind, value in memory.items():
+        PROCESS_MEMORY.set(value, kind=kind)
+    return memory
+
+
+class RunProfiler:
+    """Accumulate cProfile stats and tracemalloc peaks over many captures.
+
+    ``dump()`` writes ``<name>.prof`` (load with pstats or snakeviz) and
+    ``<name>-memory.txt`` (peak traced memory and top allocation sites of
+    the capture with the highest peak) into ``out_dir``.
+    """
+
+    def __init__(self, out_dir, name, top=25):
+        self.out_dir = out_dir
+        self.name = name
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.peak = 0
+        self._top_stats = []
+
+    @contextmanager
+    def capture(self):
+        own_tracing = not tracemalloc.is_tracing()
+        if own_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            peak = tracemalloc.get_traced_memory()[1]
+            if peak >= self.peak:
+                self.peak = peak
+                self._top_stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+            if own_tracing:
+                tracemalloc.stop()
+
+    def dump(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.profile.dump_stats(os.path.join(self.out_dir, f"{self.name}.prof"))
+        with open(os.path.join(self.out_dir, f"{self.name}-memory.txt"), 'w') as f:
+            f.write(f"peak traced memory: {self.peak / 1e6:.1f} MB\n\n")
+            for stat in self._top_stats:
+                f.write(f"{stat}\n")
+
+
+_PROFILERS = {}
+
+
+def get_run_profiler(run_dir, name):
+    """Per-process profiler for a run (workers keep one each, named by pid)."""
+    key = (run_dir, name)
+    profiler = _PROFILERS.get(key)
+    if profiler is None:
+        if len(_PROFILERS) >= 8:
+            _PROFILERS.clear()
+        profiler = _PROFILERS[key] = RunProfiler(os.path.join(run_dir, 'profile'), name)
+    return profiler
+
+
+def profiled_call(run_dir, name, fn, *args, **kwargs):
+    """Call ``fn`` under the run's profiler and write the updated capture."""
+    profiler = get_run_profiler(run_dir, name)
+    with profiler.capture():
+        result = fn(*args, **kwargs)
+    profiler.dump()
+    return result
@@ -0,0 +1,64 @@
+"""Named output profiles for rendered certificates.
+
+A profile picks the file format, resolution and encoder settings of each
+certificate. The template is 3508x2480 user units, i.e. A4 landscape at
+300 DPI; lower DPIs scale the rasterization itself rather than resizing a
+full-size render, so a 150 DPI web profile draws a quarter of the pixels.
+
+- ``print``: 300 DPI PNG (the previous output).
+- ``web``: 150 DPI JPEG, for sharing and on-screen viewing.
+- ``web-webp``: 150 DPI WebP, smaller still.
+- ``pdf``: one vector PDF page per certificate, no rasterization at all.
+"""
+from io import BytesIO
+
+TEMPLATE_DPI = 300
+DEFAULT_PROFILE = 'print'
+
+PROFILES = {
+    'print': {'format': 'PNG', 'dpi': 300, 'compress_level': 6, 'ext': '.png'},
+    'web': {'format': 'JPEG', 'dpi': 150, 'quality': 85, 'ext': '.jpg'},
+    'web-webp': {'format': 'WEBP', 'dpi': 150, 'quality': 80, 'method': 4, 'ext': '.webp'},
+    'pdf': {'format': 'PDF', 'dpi': 300, 'ext': '.pdf'},
+}
+
+OUTPUT_EXTENSIONS = tuple(sorted({p['ext'] for p in PROFILES.values()}))
+
+
+def get_profile(name=None):
+    """Profile settings by name (a copy, with 'name' filled in)."""
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown output profile '{name}' (choose from {', '.join(PROFILES)})")
+    return dict(PROFILES[name], name=name)
+
+
+def profile_scale(profile):
+    """Render scale relative to the template's native 300 DPI."""
+    return profile['dpi'] / TEMPLATE_DPI
+
+
+def is_raster(profile):
+    return profile['format'] != 'PDF'
+
+
+def encode_image(img, profile):
+    """Encode a rendered PIL image with the profile's format and settings."""
+    buf = BytesIO()
+    fmt = profile['format']
+    if fmt == 'PNG':
+        img.save(buf, format='PNG', compress_level=profile.get('compress_level', 6))
+    else:
+        if img.mode != 'RGB':
+            # JPEG has no alpha: flatten onto white like a printed page
+            from PIL import Image
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A') if 'A' in img.getbands() else None)
+            img = background
+        if fmt == 'JPEG':
+            img.save(buf, format='JPEG', quality=profile.get('quality', 85))
+        elif fmt == 'WEBP':
+            img.save(buf, format='WEBP', quality=profile.get('quality', 80), method=profile.get('method', 4))
+        else:
+            raise ValueError(f"Profile format {fmt} is not a raster format")
+    return buf.getvalue()
@@ -0,0 +1,78 @@
+"""Merged-PDF export that writes one page at a time.
+
+Pages are drawn by cairosvg straight onto a single multi-page cairo PDF
+surface, so text, borders and the QR stay vector and only the photo and
+signature are embedded as images. The surface writes into a sink that is
+drained after every page, which keeps memory bounded and lets the caller
+stream the PDF to the client while later pages are still being drawn.
+"""
+import cairocffi as cairo
+from cairosvg.parser import Tree
+from cairosvg.surface import PDFSurface
+from PIL import Image
+
+from zip_stream import ChunkSink
+
+# 3508x2480 px template at 300 DPI -> A4 landscape pages
+PAGE_DPI = 300
+
+
+class _SharedPDFPage(PDFSurface):
+    """cairosvg PDF surface that draws onto an existing multi-page surface."""
+
+    def __init__(self, tree, target, dpi=PAGE_DPI):
+        self._target = target
+        super().__init__(tree, None, dpi)
+
+    def _create_surface(self, width, height):
+        self._target.set_size(width, height)
+        return self._target, width, height
+
+
+def iter_merged_pdf(svg_pages, url_fetcher=None, dpi=PAGE_DPI):
+    """Yield a PDF with one vector page per SVG string, chunk by chunk."""
+    sink = ChunkSink()
+    surface = cairo.PDFSurface(sink, 1, 1)
+    tree_kwargs = {'url_fetcher': url_fetcher} if url_fetcher else {}
+    for svg_data in svg_pages:
+        tree = Tree(bytestring=svg_data.encode('utf-8'), **tree_kwargs)
+        _SharedPDFPage(tree, surface, dpi)
+        surface.show_page()
+        if sink.pending:
+            yield sink.take()
+    surface.finish()
+    yield sink.take()
+
+
+def iter_raster_pdf(image_paths, dpi=PAGE_DPI):
+    """Fallback: one page per already rendered certificate image.
+
+    Each image is loaded, painted and released before the next one, unlike
+    PIL's save_all which keeps every page in memory.
+    """
+    sink = ChunkSink()
+    surface = cairo.PDFSurface(sink, 1, 1)
+    scale = 72.0 / dpi
+    for path in image_paths:
+        with Image.open(path) as img:
+            img = img.convert('RGBA')
+            data = bytearray(img.tobytes('raw', 'BGRa'))
+            width, height = img.size
+        page = cairo.ImageSurface.create_for_data(
+            data, cairo.FORMAT_ARGB32, width, height, width * 4)
+        surface.set_size(width * scale, height * scale)
+        context = cairo.Context(surface)
+        context.scale(scale, scale)
+        context.set_source_surface(page)
+        context.paint()
+        del context, page, data
+        surface.show_page()
+        if sink.pending:
+            yield sink.take()
+    surface.finish()
+    yield sink.take()
+
+
+def svg_to_pdf(svg_data, url_fetcher=None, dpi=PAGE_DPI):
+    """Single-page vector PDF for one certificate."""
+    return b''.join(iter_merged_pdf([svg_data], url_fetcher, dpi))
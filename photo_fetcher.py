@@ -0,0 +1,148 @@
+"""Pooled, cached, concurrency-limited fetcher for remote (Google Drive) photos.
+
+One ``requests.Session`` with a sized connection pool is shared by every row
+thread (and every run in the same process), so photos reuse TCP/TLS
+connections. Each host gets its own concurrency limit, transient failures are
+retried with exponential backoff, and successful downloads are kept in an
+on-disk cache keyed by Drive file ID so re-running a roster downloads nothing.
+
+``drive_url`` can point at a local stand-in server for testing.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+from logs import get_logger
+
+log = get_logger('photos')
+
+DRIVE_DOWNLOAD_URL = 'https://drive.google.com/uc?export=download&id={file_id}'
+
+_DRIVE_ID_PATTERNS = [
+    r'id=([a-zA-Z0-9_-]+)',
+    r'/d/([a-zA-Z0-9_-]+)',
+    r'/open\?id=([a-zA-Z0-9_-]+)'
+]
+
+
+def extract_drive_file_id(url):
+    """Return the file ID of a Google Drive share link, or None."""
+    if 'drive.google.com' not in url:
+        return None
+    for p in _DRIVE_ID_PATTERNS:
+        match = re.search(p, url)
+        if match:
+            return match.group(1)
+    return None
+
+
+class PhotoFetcher:
+    def __init__(self, cache_dir=None, drive_url=None, per_host_limit=8, pool_size=32,
+                 retries=3, backoff=0.5, timeout=(3.05, 10)):
+        self.cache_dir = cache_dir or os.environ.get(
+            'PHOTO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'certificate_photo_cache'))
+        self.drive_url = drive_url or os.environ.get('DRIVE_DOWNLOAD_URL', DRIVE_DOWNLOAD_URL)
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+
+        # Imported here: only rosters with Drive links ever build a fetcher
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._host_slots = {}  # netloc -> BoundedSemaphore
+        self._key_locks = {}   # cache key -> Lock (one download per file ID at a time)
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return slot
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _cache_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _cache_get(self, key):
+        try:
+            with open(self._cache_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _cache_put(self, key, data):
+        path = self._cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent runs never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Could not cache photo %s: %s", key, e)
+
+    def fetch(self, url, cache_key=None):
+        """GET ``url`` through the pool; returns bytes or None on failure."""
+        key = cache_key or url
+        data = self._cache_get(key)
+        if data is not None:
+            return data
+        with self._key_lock(key):
+            data = self._cache_get(key)  # another thread may have just fetched it
+            if data is not None:
+                return data
+            import requests
+            try:
+                with self._host_slot(url):
+                    response = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.warning("Exception downloading %s: %s", url, e)
+                return None
+            if response.status_code != 200:
+                return None
+            data = response.content
+            # Drive answers quota / virus-scan interstitials with HTML: don't cache those
+            if data and 'text/html' not in response.headers.get('Content-Type', ''):
+                self._cache_put(key, data)
+            return data
+
+    def fetch_drive(self, file_id):
+        return self.fetch(self.drive_url.format(file_id=file_id), cache_key=f"drive:{file_id}")
+
+
+_DEFAULT_FETCHER = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+def get_default_fetcher():
+    """Process-wide fetcher so the connection pool and cache outlive each run."""
+    global _DEFAULT_FETCHER
+    with _DEFAULT_LOCK:  # first use may come from several row threads at once
+        if _DEFAULT_FETCHER is None:
+            _DEFAULT_FETCHER = PhotoFetcher()
+        return _DEFAULT_FETCHER
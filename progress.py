@@ -0,0 +1,167 @@
+"""Structured run progress shared between the batch worker and the web app.
+
+The worker owns a ProgressTracker and publishes two small files in the run
+directory:
+
+- ``progress.json``: counters, rate, ETA and per-stage timings, rewritten
+  atomically at most every ``min_interval`` seconds.
+- ``completed.log``: append-only list of finished certificate filenames, so
+  readers can tail new entries from a byte offset instead of re-listing the
+  output directory.
+
+The render service can additionally keep ``results.log`` (one JSON line per
+record, failures included) for clients that stream per-certificate results.
+"""
+import json
+import os
+import time
+
+from metrics import CERTIFICATES, RENDER_STAGE_SECONDS, RUNS
+
+PROGRESS_FILE = 'progress.json'
+COMPLETED_LOG = 'completed.log'
+RESULTS_LOG = 'results.log'
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class ProgressTracker:
+    def __init__(self, run_dir, total, min_interval=0.5):
+        self.run_dir = run_dir
+        self.total = total
+        self.min_interval = min_interval
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0  # already up to date (see run_manifest), counted in done
+        self.stages = {}  # stage -> {'count': n, 'total_ms': ms}
+        self.status = 'processing'
+        self.started_at = time.time()
+        self._last_publish = 0.0
+        # One log per pass over the run: a resumed run lists its skipped files again
+        self._log = open(os.path.join(run_dir, COMPLETED_LOG), 'w')
+
+    def record(self, ok, filename=None, timings=None, skipped=False):
+        """Account for one finished record (``timings`` in seconds per stage)."""
+        if skipped:
+            CERTIFICATES.inc(result='skipped')
+        elif not ok:
+            CERTIFICATES.inc(result='failed')
+        else:
+            CERTIFICATES.inc(result='cached' if timings and 'cached' in timings else 'rendered')
+        if skipped:
+            self.skipped += 1
+        if ok:
+            self.done += 1
+            if filename:
+                self._log.write(filename + '\n')
+                self._log.flush()
+        else:
+            self.failed += 1
+        for stage, seconds in (timings or {}).items():
+            entry = self.stages.setdefault(stage, {'count': 0, 'total_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] += seconds * 1000.0
+            RENDER_STAGE_SECONDS.observe(seconds, stage=stage)
+        self.publish()
+
+    def snapshot(self):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        finished = self.done + self.failed
+        rate = (finished - self.skipped) / elapsed
+        remaining = max(self.total - finished, 0)
+        return {
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'elapsed': round(elapsed, 2),
+            'rate': round(rate, 3),
+            'eta_seconds': round(remaining / rate, 1) if rate and self.status == 'processing' else None,
+            'stages': {
+                stage: {
+                    'count': v['count'],
+                    'total_ms': round(v['total_ms'], 1),
+                    'avg_ms': round(v['total_ms'] / v['count'], 2) if v['count'] else 0,
+                }
+                for stage, v in self.stages.items()
+            },
+            'updated_at': time.time(),
+        }
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self._last_publish < self.min_interval:
+            return
+        self._last_publish = now
+        write_json_atomic(os.path.join(self.run_dir, PROGRESS_FILE), self.snapshot())
+
+    def start(self):
+        """Publish the initial state and mark the run as processing."""
+        self.publish(force=True)
+        self._update_metadata(status=self.status, total=self.total)
+
+    def finish(self, status=None):
+        """Publish the final state and flip metadata.json out of 'processing'."""
+        self.status = status or ('failed' if self.failed and not self.done else 'completed')
+        self.publish(force=True)
+        self._log.close()
+        RUNS.inc(status=self.status)
+        self._update_metadata(status=self.status, done=self.done, failed=self.failed,
+                              skipped=self.skipped, finished_at=time.time())
+
+    def _update_metadata(self, **values):
+        metadata_path = os.path.join(self.run_dir, 'metadata.json')
+        try:
+            with open(metadata_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {'total': self.total}
+        meta.update(values)
+        write_json_atomic(metadata_path, meta)
+
+
+def read_progress(run_dir):
+    """Latest published progress, or None if the worker has not published yet."""
+    try:
+        with open(os.path.join(run_dir, PROGRESS_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_lines(path, offset):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        return [], offset
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].decode('utf-8').splitlines()
+    return [line for line in lines if line], offset + end
+
+
+def read_completed(run_dir, offset=0):
+    """Filenames appended to completed.log after byte ``offset``.
+
+    Returns (filenames, new_offset); a trailing partial line is left for the
+    next call.
+    """
+    return _read_lines(os.path.join(run_dir, COMPLETED_LOG), offset)
+
+
+def read_results(run_dir, offset=0):
+    """Per-record results (dicts) appended to results.log after byte ``offset``.
+
+    Written by the render service for runs submitted with ``results_log``;
+    the last entry of a finished pass is ``{'done': True, 'status': ...}``.
+    """
+    lines, offset = _read_lines(os.path.join(run_dir, RESULTS_LOG), offset)
+    return [json.loads(line) for line in lines], offset
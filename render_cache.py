@@ -0,0 +1,166 @@
+"""Content-addressed cache of rendered certificates, shared across runs.
+
+Entries are keyed by a hash of everything the output depends on: the
+formatted template fields (photos are referenced by content hash), the
+template itself, the signature image, the render mode and the output
+profile. Reprints, regenerated batches and the single ``/generate`` route
+then reuse the artifact instead of rasterizing it again.
+
+Entries are plain files under ``RENDER_CACHE_DIR``. A hit refreshes the
+file's mtime, and once the cache grows past ``RENDER_CACHE_MAX_MB`` the
+least recently used entries are deleted (0 disables the cache). Several
+worker processes can share one directory: writes are atomic renames and
+eviction only ever removes whole files.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from functools import lru_cache
+
+from logs import get_logger
+
+log = get_logger('render_cache')
+
+DEFAULT_MAX_MB = 2048
+
+
+@lru_cache(maxsize=16)
+def _text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=16)
+def _file_digest(path, mtime_ns):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def render_key(svg_template, fields, profile, render_mode, signature_path=None, **extra):
+    """Cache key for one certificate; ``extra`` holds any other input (e.g. domain)."""
+    h = hashlib.sha1(_text_digest(svg_template).encode('utf-8'))
+    if signature_path:
+        h.update(_file_digest(signature_path, os.stat(signature_path).st_mtime_ns).encode('utf-8'))
+    h.update(json.dumps([fields, profile, render_mode, extra], sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+class RenderCache:
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.environ.get(
+            'RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'certificate_render_cache'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('RENDER_CACHE_MAX_MB', DEFAULT_MAX_MB)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None  # bytes on disk as last seen by this process
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Cached bytes for ``key`` or None."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._touch(path)
+        return data
+
+    def copy_to(self, key, dest):
+        """Place the cached artifact at ``dest`` (atomically); False on a miss."""
+        if not self.enabled:
+            return False
+        path = self._path(key)
+        part = dest + '.part'
+        try:
+            try:
+                os.link(path, part)  # same filesystem: no bytes copied
+            except OSError:
+                shutil.copyfile(path, part)
+        except OSError:
+            if os.path.exists(part):
+                os.remove(part)
+            return False
+        os.replace(part, dest)
+        self._touch(path)
+        return True
+
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Could not cache render %s: %s", key, e)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[0]
+            else:
+                self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _scan(self):
+        """(total_bytes, [(mtime, size, path), ...]) of the entries on disk."""
+        total = 0
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # evicted by another process
+                total += st.st_size
+                entries.append((st.st_mtime, st.st_size, path))
+        return total, entries
+
+    def evict(self, target_ratio=0.9):
+        """Remove least recently used entries until under ``target_ratio`` of the budget."""
+        with self._lock:
+            total, entries = self._scan()
+            target = self.max_bytes * target_ratio
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._size = total
+
+
+_DEFAULT_CACHE = None
+
+
+def get_render_cache():
+    """Process-wide cache (every process points at the same directory)."""
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        _DEFAULT_CACHE = RenderCache()
+    return _DEFAULT_CACHE
@@ -0,0 +1,411 @@
+"""Certificate render engine: roster record in, encoded certificate out.
+
+The one render path used by the web routes, the render service and the
+batch workers. It imports only the rendering modules (no Flask, pandas or
+requests), so worker processes load nothing they don't use.
+
+A RenderEngine holds everything a batch shares: the QR-vectorized template,
+the signature asset, the layered renderer per output scale and the roster's
+QR version. ``render_many`` streams records through one engine; engines are
+memoized per process by ``get_engine``.
+
+    for result in render_many(records, 'web', svg_template=template,
+                              signature_path='signature.png', domain=domain):
+        ...
+"""
+import os
+import re
+import time
+from functools import lru_cache
+from urllib.parse import quote
+
+from PIL import Image
+from qrcode.constants import ERROR_CORRECT_H
+
+from asset_registry import get_registry
+from layer_cache import extract_image_slots, get_layered_renderer, svg_to_image
+from logs import get_logger
+from output_profiles import encode_image, get_profile, is_raster, profile_scale
+from pdf_export import svg_to_pdf
+from qr_vector import fit_qr_version, qr_matrix, qr_path_fields, vectorize_qr_template
+from render_cache import get_render_cache, render_key
+
+log = get_logger('engine')
+
+QR_ERROR_CORRECTION = ERROR_CORRECT_H
+QR_BORDER = 4
+QR_BOX_SIZE = 10  # pixels per module of raster QR images
+DEFAULT_DATE = '08-02-2026'
+
+
+def load_template(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@lru_cache(maxsize=8)
+def _load_template_version(path, mtime_ns):
+    return load_template(path)
+
+
+def cached_template(path):
+    """Template text, read again only when the file changes."""
+    return _load_template_version(path, os.stat(path).st_mtime_ns)
+
+
+def get_display_name(rec):
+    raw_name = str(rec.get('name', 'Unknown'))
+    # ENFORCE ENGLISH ONLY (Remove non-ascii)
+    name = re.sub(r'[^\x00-\x7F]+', '', raw_name).strip().upper()
+    return name or "UNKNOWN"
+
+
+def get_roll(rec):
+    roll = rec.get('roll')
+    if roll is None or str(roll).strip() == '':
+        return 'N/A' # blank cell: same as no roll column, never a bare 'AIK' cert_id
+    return str(roll).upper()
+
+
+def get_cert_id(rec):
+    return f"AIK{get_roll(rec)}"
+
+
+def has_cert_id(rec):
+    """Whether the record has a roll, i.e. a cert_id of its own.
+
+    Roll-less records would all share ``AIKN/A``: they are neither registered
+    nor given a validation QR code.
+    """
+    return get_roll(rec) != 'N/A'
+
+
+def certificate_entry(rec):
+    """What the validation page shows for a record, as printed on its certificate."""
+    return {'cert_id': get_cert_id(rec), 'name': get_display_name(rec), 'roll': get_roll(rec),
+            'date': str(rec.get('date', DEFAULT_DATE))}
+
+
+def get_validation_url(cert_id, domain_url):
+    # One path segment even for rolls with '/', '?' or '#'
+    return f"{domain_url}/validate/{quote(cert_id, safe='')}"
+
+
+def get_record_validation_url(rec, domain_url):
+    """The record's QR target, or None when it has no cert_id of its own."""
+    return get_validation_url(get_cert_id(rec), domain_url) if has_cert_id(rec) else None
+
+
+def get_output_filename(name, roll, ext='.png'):
+    safe_name = re.sub(r'[^a-zA-Z0-9_\-]', '_', name)
+    safe_roll = re.sub(r'[^a-zA-Z0-9_\-]', '_', roll)
+    return f"{safe_roll}_{safe_name}{ext}"
+
+
+def get_record_filename(rec, ext='.png'):
+    return get_output_filename(get_display_name(rec), get_roll(rec), ext)
+
+
+def get_main_name_fontsize(name):
+    name_len = len(name)
+    if name_len <= 15: return 160
+    elif name_len <= 20: return 140
+    elif name_len <= 30: return 110
+    elif name_len <= 40: return 90
+    return 70
+
+
+def get_wrapped_name_svg(name):
+    """Wrap name for ID card into SVG tspans with dynamic font size."""
+    # Clean non-ascii (English only request)
+    name = re.sub(r'[^\x00-\x7F]+', '', name).strip()
+
+    words = name.split()
+    if not words: return "", 50
+    full_name_len = len(name)
+
+    # Prefer single line if possible up to 20 chars
+    if full_name_len <= 20:
+        fontsize = 45 if full_name_len <= 15 else 35
+        return f'<tspan x="300" dy="1.2em">{name}</tspan>', fontsize
+
+    # Medium name (2 lines): fill the first line up to 18 chars
+    if full_name_len <= 35:
+        if len(words) == 1:
+            return f'<tspan x="300" dy="1.2em">{name}</tspan>', 30
+        line1 = words[0]
+        idx = 1
+        while idx < len(words) and len(line1) + 1 + len(words[idx]) < 18:
+            line1 += " " + words[idx]
+            idx += 1
+        line2 = " ".join(words[idx:])
+        return f'<tspan x="300" dy="0">{line1}</tspan><tspan x="300" dy="1.2em">{line2}</tspan>', 40
+
+    # Long name: greedy 18-char lines, at most 3
+    lines = []
+    current_line = ""
+    for word in words:
+        if len(current_line) + len(word) + 1 <= 18:
+            if current_line: current_line += " "
+            current_line += word
+        else:
+            if current_line: lines.append(current_line)
+            current_line = word
+    if current_line: lines.append(current_line)
+
+    if len(lines) == 1:
+        return f'<tspan x="300" dy="1.2em">{lines[0]}</tspan>', 35
+    elif len(lines) == 2:
+        return f'<tspan x="300" dy="0">{lines[0]}</tspan><tspan x="300" dy="1.2em">{lines[1]}</tspan>', 35
+    svg_lines = [f'<tspan x="300" dy="-0.5em">{lines[0]}</tspan>']
+    for line in lines[1:3]:
+        svg_lines.append(f'<tspan x="300" dy="1.1em">{line}</tspan>')
+    return "".join(svg_lines), 30
+
+
+def get_photo_ref(rec, registry, photos=None):
+    """Register the record's photo: raw bytes, a slice of the run's photo blob or a data URI."""
+    photo = rec.get('photo')
+    if isinstance(photo, (bytes, bytearray, memoryview)):
+        return registry.put_bytes(bytes(photo))
+    if photos is not None and photo:
+        return registry.put_bytes(photos.get(photo))
+    return registry.put_data_uri(rec.get('photo_base64', ''))
+
+
+def fit_roster_qr_version(records, domain):
+    """One QR version for a whole roster: uniform module size, no per-record best fit."""
+    urls = [get_record_validation_url(rec, domain) for rec in records]
+    return fit_qr_version([url for url in urls if url], QR_ERROR_CORRECTION)
+
+
+def qr_image(url, version=None):
+    """Raster QR for ``url``, built from the (memoized) module matrix."""
+    matrix = qr_matrix(url, QR_ERROR_CORRECTION, QR_BORDER, version)
+    size = len(matrix)
+    img = Image.new('L', (size, size))
+    img.putdata([0 if module else 255 for row in matrix for module in row])
+    return img.resize((size * QR_BOX_SIZE, size * QR_BOX_SIZE), Image.NEAREST)
+
+
+def _resolve_profile(profile):
+    """Profile settings from a name (None = default) or an already resolved profile."""
+    return profile if isinstance(profile, dict) else get_profile(profile)
+
+
+def photo_slot(svg_template, profile=None):
+    """Pixel box and fit of the template's photo at the profile's DPI (None if it has none).
+
+    Photos normalized to this size at ingestion are pasted without resampling.
+    """
+    scale = profile_scale(_resolve_profile(profile))
+    for slot in extract_image_slots(svg_template)[1]:
+        if slot['field'] == 'photo_base64':
+            # Same rounding as LayeredRenderer._paste_slots
+            return dict(slot, width=max(1, int(round(slot['width'] * scale))),
+                        height=max(1, int(round(slot['height'] * scale))))
+    return None
+
+
+class RenderEngine:
+    """Renders certificates for one template, signature, domain and mode."""
+
+    def __init__(self, svg_template, signature_path, domain, render_mode='layered', qr_mode='vector',
+                 qr_version=None, registry=None):
+        self.registry = registry or get_registry()
+        self.signature_path = signature_path
+        self.domain = domain
+        self.render_mode = render_mode
+        self.qr_mode = qr_mode
+        self.qr_version = qr_version
+        self.qr_size = None
+        if qr_mode == 'vector':
+            # QR modules inlined as an SVG path: no PIL image, no PNG codec
+            svg_template, self.qr_size = vectorize_qr_template(svg_template)
+        self.svg_template = svg_template
+        # Photo box at the template's native 300 DPI, the most any output needs
+        self.photo_slot = photo_slot(svg_template)
+
+    def signature_ref(self):
+        # Cheap when already registered; re-registers after an LRU eviction
+        return self.registry.put_file(self.signature_path, key='signature')
+
+    def prepare(self, rec, ext='.png', photos=None):
+        """Normalize one record into template fields.
+
+        Returns (fields, filename, refs): ``fields`` excludes the signature and
+        ``refs`` are per-record assets to release once the certificate is
+        rendered. ``photos`` is the run's PhotoBlob for compact run records.
+        """
+        name = get_display_name(rec)
+        roll = get_roll(rec)
+        cert_id = get_cert_id(rec)
+        photo_ref = get_photo_ref(rec, self.registry, photos)
+        refs = [photo_ref]
+
+        id_name_content, id_name_fontsize = get_wrapped_name_svg(name)
+        fields = dict(
+            name=name,
+            roll_no=roll,
+            photo_base64=photo_ref,
+            cert_id=cert_id,
+            id_name_content=id_name_content,
+            id_name_fontsize=id_name_fontsize,
+            main_name_fontsize=get_main_name_fontsize(name),
+            date=str(rec.get('date', DEFAULT_DATE))
+        )
+        url = get_record_validation_url(rec, self.domain)
+        if url is None:
+            # Empty QR slot: nothing to validate
+            fields.update(qr_path='', qr_scale='1', qr_base64='')
+        elif self.qr_mode == 'vector':
+            fields.update(qr_path_fields(url, self.qr_size, QR_ERROR_CORRECTION, QR_BORDER, self.qr_version))
+        else:
+            qr_ref = self.registry.put_image(qr_image(url, self.qr_version), key=f"qr-{cert_id}")
+            fields['qr_base64'] = qr_ref
+            refs.append(qr_ref)
+        return fields, get_output_filename(name, roll, ext), refs
+
+    def release(self, refs):
+        for ref in refs:
+            self.registry.release(ref)
+
+    def format_svg(self, fields):
+        photo = fields.get('photo_base64')
+        slot = self.photo_slot
+        if photo and slot:
+            # cairosvg gets the photo at slot size, not as uploaded
+            photo = self.registry.fitted_ref(photo, slot['width'], slot['height'], slot['fit'], slot['align'])
+            fields = dict(fields, photo_base64=photo)
+        return self.svg_template.format(signature_base64=self.signature_ref(), **fields)
+
+    def warm(self, profile=None):
+        """Rasterize the static layers for ``profile`` ahead of the first record."""
+        profile = _resolve_profile(profile)
+        if self.render_mode == 'layered' and is_raster(profile):
+            self._layered_renderer(profile)
+
+    def _layered_renderer(self, profile):
+        return get_layered_renderer(self.svg_template, self.registry, profile_scale(profile),
+                                    signature_base64=self.signature_ref())
+
+    def _encode(self, fields, profile, timings):
+        """Encoded bytes for one certificate, with render/encode timings."""
+        t0 = time.perf_counter()
+        if not is_raster(profile):
+            # Vector page straight from the SVG: nothing to rasterize or encode
+            data = svg_to_pdf(self.format_svg(fields), self.registry.url_fetcher)
+            timings['render'] = time.perf_counter() - t0
+            return data
+        if self.render_mode == 'layered':
+            # Static layers are rasterized once per process, only the overlay per record
+            img = self._layered_renderer(profile).render(**fields)
+        else:
+            img = svg_to_image(self.format_svg(fields), profile_scale(profile),
+                               url_fetcher=self.registry.url_fetcher)
+        t1 = time.perf_counter()
+        timings['render'] = t1 - t0
+        data = encode_image(img, profile)
+        timings['encode'] = time.perf_counter() - t1
+        return data
+
+    def render(self, rec, profile=None, photos=None, out_dir=None):
+        """Render one record with the given output profile.
+
+        Returns {'ok', 'filename', 'timings'} plus 'data' (the encoded bytes)
+        unless ``out_dir`` is given, in which case the file is written there
+        atomically. Timings are seconds per stage (prepare, render, encode,
+        write); certificates already in the shared render cache are served
+        from it (stage 'cached') without rendering.
+        """
+        profile = _resolve_profile(profile)
+        refs = []
+        timings = {}
+        try:
+            t0 = time.perf_counter()
+            fields, filename, refs = self.prepare(rec, profile['ext'], photos)
+            cache = get_render_cache()
+            cache_key = None
+            if cache.enabled:
+                cache_key = render_key(self.svg_template, fields, profile, self.render_mode,
+                                       self.signature_path, domain=self.domain)
+            out_path = os.path.join(out_dir, filename) if out_dir else None
+            t1 = time.perf_counter()
+            timings['prepare'] = t1 - t0
+
+            if cache_key:
+                if out_path and cache.copy_to(cache_key, out_path):
+                    timings['cached'] = time.perf_counter() - t1
+                    return {'ok': True, 'filename': filename, 'timings': timings}
+                data = None if out_path else cache.get(cache_key)
+                if data is not None:
+                    timings['cached'] = time.perf_counter() - t1
+                    return {'ok': True, 'filename': filename, 'timings': timings, 'data': data}
+
+            data = self._encode(fields, profile, timings)
+            t2 = time.perf_counter()
+            if cache_key:
+                cache.put(cache_key, data)
+            if not out_path:
+                return {'ok': True, 'filename': filename, 'timings': timings, 'data': data}
+            # Write-then-rename so the streaming ZIP/preview never see partial files
+            with open(out_path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(out_path + '.part', out_path)
+            timings['write'] = time.perf_counter() - t2
+            return {'ok': True, 'filename': filename, 'timings': timings}
+        except Exception as e:
+            log.exception("Error generating for %s: %s", rec.get('name'), e)
+            return {'ok': False, 'filename': None, 'timings': timings}
+        finally:
+            self.release(refs)
+
+    def render_many(self, records, profile=None, photos=None, out_dir=None):
+        """Yield ``render()`` results for ``records``, in order."""
+        profile = _resolve_profile(profile)
+        for rec in records:
+            yield self.render(rec, profile, photos, out_dir)
+
+    def iter_svgs(self, records, only_filenames=None, photos=None, ext='.png'):
+        """Yield fully formatted per-record SVGs (sorted by output filename).
+
+        Used by the vector PDF export; ``only_filenames`` restricts the pages to
+        certificates that have actually been rendered. Assets referenced by the
+        yielded SVG stay registered until the next page is requested.
+        """
+        ordered = sorted((get_record_filename(rec, ext), idx) for idx, rec in enumerate(records))
+        for filename, idx in ordered:
+            if only_filenames is not None and filename not in only_filenames:
+                continue
+            fields, _, refs = self.prepare(records[idx], ext, photos)
+            try:
+                yield self.format_svg(fields)
+            finally:
+                self.release(refs)
+
+
+_ENGINES = {}
+
+
+def get_engine(svg_template, signature_path, domain, render_mode='layered', qr_mode='vector',
+               qr_version=None, registry=None):
+    """Per-process memo, so a batch (or a worker's share of it) reuses one engine."""
+    key = (svg_template, signature_path, domain, render_mode, qr_mode, qr_version, id(registry))
+    engine = _ENGINES.get(key)
+    if engine is None:
+        if len(_ENGINES) >= 8:
+            _ENGINES.clear()
+        engine = _ENGINES[key] = RenderEngine(svg_template, signature_path, domain, render_mode,
+                                              qr_mode, qr_version, registry)
+    return engine
+
+
+def render_many(records, profile=None, photos=None, out_dir=None, **engine_options):
+    """Render a batch through one shared engine, yielding ``RenderEngine.render()`` results.
+
+    ``engine_options`` are ``get_engine()``'s arguments (svg_template,
+    signature_path, domain, render_mode, qr_mode, qr_version). Pass a
+    roster-wide ``qr_version`` (see fit_roster_qr_version) to skip the
+    per-record QR best-fit search.
+    """
+    return get_engine(**engine_options).render_many(records, profile, photos, out_dir)
@@ -0,0 +1,381 @@
+"""Long-lived render service shared by every upload handled by this process.
+
+Instead of spawning ``batch_processor.py`` (a fresh interpreter plus a fresh
+process pool) per upload, runs are queued here and rendered by one warm
+process pool whose workers have the template, signature and static layers
+loaded before the first record arrives.
+
+- Global limit: at most ``max_workers`` renders run at once, with a small
+  number of extra records queued per worker so the pool never idles.
+- Fairness: records are dispatched round-robin across active runs, so a
+  large roster does not hold back a small one submitted after it.
+- Cancellation: ``cancel(run_id)`` drops the run's pending records and any
+  dispatched ones that have not started yet.
+
+Under gunicorn the service runs in one dedicated process started by the
+master (start_render_server) and the web workers call it through a proxy;
+``python app.py`` keeps it in-process. Size it with ``RENDER_WORKERS``.
+"""
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.managers import BaseManager
+
+import batch_processor
+from cert_registry import issue_certificates
+from logs import get_logger, setup_logging
+from metrics import REGISTRY, RENDER_METRICS, profiled_call
+from output_profiles import get_profile
+from progress import RESULTS_LOG, ProgressTracker
+from render_engine import (RenderEngine, cached_template, fit_roster_qr_version, get_cert_id, get_engine,
+                           get_record_filename)
+from run_manifest import RunManifest
+from run_store import load_records, open_photo_blob
+
+log = get_logger('render')
+
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _warm_worker(template_path, signature_path):
+    """Pool initializer: pay template parsing and static-layer rendering up front."""
+    setup_logging()
+    try:
+        # Static layers are shared by every engine on this template (any domain)
+        RenderEngine(cached_template(template_path), signature_path, None).warm()
+    except Exception as e:
+        # Not fatal: the first record of a run builds whatever is missing
+        log.warning("Render worker warm-up failed: %s", e)
+
+
+def _render_task(options, rec):
+    if options.get('diagnostics'):
+        # Opt-in per run: cProfile/tracemalloc dumps under <run_dir>/profile
+        return profiled_call(options['run_dir'], f"worker-{os.getpid()}", _render, options, rec)
+    return _render(options, rec)
+
+
+def _render(options, rec):
+    engine = get_engine(cached_template(options['template_path']), options['signature_path'],
+                        options['domain'], options['render_mode'], options['qr_mode'], options['qr_version'])
+    return engine.render(rec, options['profile'], open_photo_blob(options['run_dir']), options['img_out_dir'])
+
+
+def _write_result(results, rec, result):
+    if results is None:
+        return
+    results.write(json.dumps({
+        'cert_id': get_cert_id(rec),
+        'ok': bool(result['ok']),
+        'filename': result.get('filename'),
+        'render_ms': round(sum((result.get('timings') or {}).values()) * 1000, 1),
+    }) + '\n')
+    results.flush()
+
+
+class _Job:
+    def __init__(self, run_id, items, options, tracker, manifest, results=None):
+        self.run_id = run_id
+        self.pending = deque(items)  # (rec, filename, fingerprint)
+        self.options = options
+        self.tracker = tracker
+        self.manifest = manifest
+        self.results = results  # open results.log, if the submitter streams results
+        self.futures = set()
+        self.inflight = 0  # dispatched and not yet accounted for
+        self.cancelled = False
+
+
+class RenderService:
+    def __init__(self, template_path, signature_path, max_workers=None, queue_depth=2):
+        self.template_path = template_path
+        self.signature_path = signature_path
+        self.max_workers = max_workers or int(os.environ.get('RENDER_WORKERS', 0)) or batch_processor.default_worker_count()
+        self.max_inflight = self.max_workers * queue_depth
+        self._cond = threading.Condition()
+        self._jobs = OrderedDict()  # run_id -> _Job, in round-robin order
+        self._claimed = set()  # run_ids being planned by submit(), not yet in _jobs
+        self._inflight = 0
+        self._executor = None
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                # Workers start from a clean forkserver, never as a fork of this threaded
+                # process (a logging, sqlite or PIL lock could be copied held)
+                mp_context=multiprocessing.get_context(_START_METHOD),
+                initializer=_warm_worker,
+                initargs=(self.template_path, self.signature_path),
+            )
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch_loop, name='render-dispatch', daemon=True)
+            self._thread.start()
+
+    def submit(self, run_id, run_dir, domain, template_path=None, signature_path=None,
+               render_mode='layered', qr_mode='vector', profile=None, force=False, diagnostics=False,
+               results_log=False):
+        """Queue the run's records (see run_store); returns the record count.
+
+        Records the run manifest already has up-to-date output for are
+        skipped, so re-submitting a run only renders missing, changed or
+        failed certificates (``force`` renders everything).
+
+        With ``results_log`` every finished record is also appended to the
+        run's results.log (see progress.read_results), failures included.
+        """
+        with self._cond:
+            if run_id in self._jobs or run_id in self._claimed:
+                raise ValueError(f"Run {run_id} is already being rendered")
+            self._claimed.add(run_id)
+        try:
+            return self._submit(run_id, run_dir, domain, template_path, signature_path, render_mode,
+                                qr_mode, profile, force, diagnostics, results_log)
+        finally:
+            with self._cond:
+                self._claimed.discard(run_id)
+
+    def _submit(self, run_id, run_dir, domain, template_path, signature_path, render_mode, qr_mode,
+                profile, force, diagnostics, results_log):
+        records = load_records(run_dir)  # photos stay in the blob, workers map it
+        img_out_dir = os.path.join(run_dir, 'certificates')
+        os.makedirs(img_out_dir, exist_ok=True)
+
+        qr_version = None
+        if qr_mode == 'vector' and records:
+            qr_version = fit_roster_qr_version(records, domain)
+        options = {
+            'template_path': template_path or self.template_path,
+            'signature_path': signature_path or self.signature_path,
+            'run_dir': run_dir,
+            'img_out_dir': img_out_dir,
+            'domain': domain,
+            'render_mode': render_mode,
+            'qr_mode': qr_mode,
+            'qr_version': qr_version,
+            'profile': get_profile(profile)['name'],
+            'diagnostics': diagnostics,
+        }
+        ext = get_profile(profile)['ext']
+        manifest = RunManifest(run_dir)
+        manifest.prune({get_record_filename(rec, ext) for rec in records})
+        key = batch_processor.run_settings_key(
+            cached_template(options['template_path']), options['signature_path'], domain,
+            render_mode, qr_mode, qr_version, profile
+        )
+        tracker = ProgressTracker(run_dir, len(records))
+        tracker.start()
+        results = open(os.path.join(run_dir, RESULTS_LOG), 'w') if results_log else None
+        items = []
+        for rec, filename, fingerprint, up_to_date in batch_processor.plan_records(
+                records, manifest, key, ext, open_photo_blob(run_dir), force):
+            if up_to_date:
+                tracker.record(True, filename, skipped=True)
+                _write_result(results, rec, {'ok': True, 'filename': filename, 'timings': {}})
+            else:
+                items.append((rec, filename, fingerprint))
+
+        with self._cond:
+            job = _Job(run_id, items, options, tracker, manifest, results)
+            self._jobs[run_id] = job
+            self._ensure_started()
+            self._finish_if_idle(job)  # empty roster
+            self._cond.notify_all()
+        log.info("Queued run %s (%d of %d records to render)", run_id, len(items), len(records))
+        return len(records)
+
+    def cancel(self, run_id):
+        """Stop a queued or running run; returns False if it is not active."""
+        with self._cond:
+            job = self._jobs.get(run_id)
+            if job is None:
+                return False
+            job.cancelled = True
+            job.pending.clear()
+            for future in list(job.futures):
+                future.cancel()  # only succeeds for records no worker has picked up
+            self._finish_if_idle(job)
+            self._cond.notify_all()
+        return True
+
+    def is_active(self, run_id):
+        with self._cond:
+            return run_id in self._jobs or run_id in self._claimed
+
+    def metrics(self):
+        """This process's render metrics (RENDER_METRICS) in Prometheus text format."""
+        return REGISTRY.render(names=RENDER_METRICS)
+
+    def _next_task(self):
+        """Next (job, item) in round-robin order, or None."""
+        if self._inflight >= self.max_inflight:
+            return None
+        for run_id, job in self._jobs.items():
+            if job.pending:
+                self._jobs.move_to_end(run_id)
+                return job, job.pending.popleft()
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+                job, item = task
+                self._inflight += 1
+                job.inflight += 1
+                executor = self._executor
+            try:
+                future = executor.submit(_render_task, job.options, item[0])
+            except BrokenProcessPool as e:
+                self._restart_pool(executor, e)
+                with self._cond:
+                    self._inflight -= 1
+                    job.inflight -= 1
+                    if not job.cancelled:
+                        job.pending.appendleft(item)
+                    self._finish_if_idle(job)
+                continue
+            with self._cond:
+                job.futures.add(future)
+                if job.cancelled:
+                    future.cancel()
+            future.add_done_callback(lambda f, job=job, item=item, ex=executor: self._on_done(job, item, f, ex))
+
+    def _restart_pool(self, executor, error):
+        with self._cond:
+            if self._executor is not executor:
+                return  # already replaced
+            log.error("Render pool broke (%s); starting a new one", error)
+            self._executor = None
+            self._ensure_started()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, job, item, future, executor):
+        result = None
+        if not future.cancelled():
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                self._restart_pool(executor, e)
+                result = {'ok': False}
+            except Exception as e:
+                log.error("Worker failed: %s", e)
+                result = {'ok': False}
+        if result is not None and result['ok']:
+            # Scannable before the run reports it; outside the lock so dispatch never waits on it
+            try:
+                issue_certificates([item[0]], job.run_id)
+            except Exception as e:
+                log.exception("Could not register certificate of run %s: %s", job.run_id, e)
+        with self._cond:
+            # Accounting first: a failure below must not leave the run waiting forever
+            self._inflight -= 1
+            job.inflight -= 1
+            job.futures.discard(future)
+            try:
+                if result is not None:
+                    job.manifest.mark(item[1], item[2], result['ok'])
+                    job.tracker.record(result['ok'], result.get('filename'), result.get('timings'))
+                    _write_result(job.results, item[0], result)
+            except Exception as e:
+                log.exception("Could not record a result of run %s: %s", job.run_id, e)
+            finally:
+                self._finish_if_idle(job)
+                self._cond.notify_all()
+
+    def _finish_if_idle(self, job):
+        if job.pending or job.inflight or self._jobs.get(job.run_id) is not job:
+            return
+        del self._jobs[job.run_id]
+        job.manifest.save(force=True)
+        job.tracker.finish('cancelled' if job.cancelled else None)
+        if job.results:
+            job.results.write(json.dumps({'done': True, 'status': job.tracker.status}) + '\n')
+            job.results.close()
+        log.info("Run %s %s: %d/%d (%d up to date, %d failed)", job.run_id, job.tracker.status,
+                 job.tracker.done, job.tracker.total, job.tracker.skipped, job.tracker.failed)
+
+
+_SERVICE = None
+_SERVICE_LOCK = threading.Lock()
+# Set (by start_render_server) when the service runs in its own process
+SERVICE_ADDRESS_ENV = 'RENDER_SERVICE_ADDRESS'
+# How often the render server checks that the process that started it is alive
+PARENT_CHECK_SECONDS = 2
+
+
+class _ServiceManager(BaseManager):
+    pass
+
+
+def _local_service(template_path, signature_path):
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = RenderService(template_path, signature_path)
+        return _SERVICE
+
+
+def _server_init(parent_pid):
+    """Manager process initializer: undo the gunicorn master's signal setup.
+
+    Forked from the arbiter, the process would inherit handlers that only
+    queue SIGTERM/SIGINT/SIGHUP for the arbiter's loop, i.e. ignore them here.
+    It also exits once the master is gone, even if the master was killed.
+    """
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    setup_logging()
+
+    def watch_parent():
+        while os.getppid() == parent_pid:
+            time.sleep(PARENT_CHECK_SECONDS)
+        log.warning("Render server exiting: its parent process %s is gone", parent_pid)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch_parent, name='render-server-parent', daemon=True).start()
+
+
+def start_render_server(template_path, signature_path):
+    """Run the service in a dedicated process that every web worker talks to.
+
+    Called by the gunicorn master before it forks: one render limit for the
+    whole server, and any worker can see, cancel or retry any run. Workers
+    find it through SERVICE_ADDRESS_ENV. Returns the manager (``shutdown()``
+    stops the service).
+    """
+    address = os.path.join(tempfile.mkdtemp(prefix='certgen-render-'), 'service.sock')
+    _ServiceManager.register('service', callable=lambda: _local_service(template_path, signature_path))
+    manager = _ServiceManager(address=address)
+    manager.start(initializer=_server_init, initargs=(os.getpid(),))
+    os.environ[SERVICE_ADDRESS_ENV] = address
+    log.info("Render service listening on %s", address)
+    return manager
+
+
+def get_render_service(template_path, signature_path):
+    """The server's render service: a proxy to the dedicated process if one
+    runs (see start_render_server), else this process's own service (the
+    pool starts with the first submitted run)."""
+    global _SERVICE
+    address = os.environ.get(SERVICE_ADDRESS_ENV)
+    if not address:
+        return _local_service(template_path, signature_path)
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _ServiceManager.register('service')
+            manager = _ServiceManager(address=address)
+            manager.connect()
+            _SERVICE = manager.service()
+        return _SERVICE
@@ -0,0 +1,103 @@
+"""Per-run manifest of rendered certificates, for resumable and incremental runs.
+
+Each output file is stored with a fingerprint of everything that went into
+it: the template, signature, render settings and output profile (the
+"settings key"), plus the record's fields and photo bytes. When a run is
+restarted or re-submitted with a corrected roster, records whose
+fingerprint matches a successful entry, and whose file is still on disk,
+are skipped. Only missing, changed or previously failed records are
+rendered again.
+
+Runs split across hosts (``batch_processor.py --shard``) keep one partial
+manifest per shard, which the merge step folds into the run's manifest.
+"""
+import hashlib
+import json
+import os
+import time
+
+from progress import write_json_atomic
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def settings_key(svg_template, signature_path, **settings):
+    """Hash of the inputs shared by every record of a run."""
+    h = hashlib.sha1()
+    h.update(svg_template.encode('utf-8'))
+    try:
+        with open(signature_path, 'rb') as f:
+            h.update(f.read())
+    except OSError:
+        h.update(b'no-signature')
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def record_fingerprint(key, rec, photo=None):
+    """Fingerprint of one record's output (``photo``: bytes-like or None)."""
+    h = hashlib.sha1(key.encode('utf-8'))
+    fields = {k: v for k, v in rec.items() if k not in ('photo', 'photo_base64')}
+    h.update(json.dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+    # Photo content, not its position in this run's blob
+    if photo:
+        h.update(photo)
+    else:
+        h.update(rec.get('photo_base64', '').encode('utf-8'))
+    return h.hexdigest()
+
+
+class RunManifest:
+    def __init__(self, run_dir, min_interval=2.0, path=None):
+        # ``path``: a partial manifest kept elsewhere (e.g. one render shard's)
+        self.path = path or os.path.join(run_dir, MANIFEST_FILE)
+        self.out_dir = os.path.join(run_dir, 'certificates')
+        self.min_interval = min_interval
+        self.entries = {}  # filename -> {'fingerprint': ..., 'ok': bool}
+        self._dirty = False
+        self._last_save = 0.0
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('entries', {})
+        except (OSError, ValueError):
+            pass
+
+    def is_current(self, filename, fingerprint):
+        """True if ``filename`` was rendered successfully from the same inputs."""
+        entry = self.entries.get(filename)
+        return bool(entry and entry['ok'] and entry['fingerprint'] == fingerprint
+                    and os.path.exists(os.path.join(self.out_dir, filename)))
+
+    def failed(self):
+        return [name for name, entry in self.entries.items() if not entry['ok']]
+
+    def mark(self, filename, fingerprint, ok):
+        self.entries[filename] = {'fingerprint': fingerprint, 'ok': bool(ok)}
+        self._dirty = True
+        self.save()
+
+    def update(self, entries):
+        """Take over entries from another manifest (e.g. a render shard's)."""
+        self.entries.update(entries)
+        self._dirty = True
+
+    def prune(self, keep):
+        """Forget (and delete the output of) certificates no longer in the roster."""
+        for filename in [f for f in self.entries if f not in keep]:
+            del self.entries[filename]
+            try:
+                os.remove(os.path.join(self.out_dir, filename))
+            except OSError:
+                pass
+            self._dirty = True
+
+    def save(self, force=False):
+        now = time.time()
+        if not self._dirty or (not force and now - self._last_save < self.min_interval):
+            return
+        self._last_save = now
+        self._dirty = False
+        write_json_atomic(self.path, {'version': MANIFEST_VERSION, 'entries': self.entries})
@@ -0,0 +1,109 @@
+"""Compact on-disk format for a run's records and photos.
+
+A run directory holds:
+
+- ``records.jsonl``: one JSON object per line with the record's fields. A
+  record with a photo carries ``"photo": [offset, length]`` pointing into
+- ``photos.bin``: every photo's JPEG bytes, concatenated.
+
+Readers stream the records line by line and memory-map the photo blob, so a
+worker can start on the first record immediately and only touches the
+bytes of the photos it renders. Older runs with a single ``records.json``
+(inline ``photo_base64`` data URIs) are still readable through iter_records.
+"""
+import json
+import mmap
+import os
+from functools import lru_cache
+
+RECORDS_FILE = 'records.jsonl'
+PHOTOS_FILE = 'photos.bin'
+LEGACY_RECORDS_FILE = 'records.json'
+
+
+def write_run(run_dir, items):
+    """Write ``items`` ([(record, photo_bytes or None), ...]); returns the count.
+
+    Both files are written under temporary names and renamed at the end, so
+    readers never see a half-written run.
+    """
+    records_path = os.path.join(run_dir, RECORDS_FILE)
+    photos_path = os.path.join(run_dir, PHOTOS_FILE)
+    count = 0
+    offset = 0
+    with open(records_path + '.part', 'w', encoding='utf-8') as records_file, \
+            open(photos_path + '.part', 'wb') as photos_file:
+        for rec, photo in items:
+            rec = dict(rec)
+            rec.pop('photo_base64', None)
+            if photo:
+                photos_file.write(photo)
+                rec['photo'] = [offset, len(photo)]
+                offset += len(photo)
+            else:
+                rec['photo'] = None
+            records_file.write(json.dumps(rec) + '\n')
+            count += 1
+    os.replace(photos_path + '.part', photos_path)
+    os.replace(records_path + '.part', records_path)
+    return count
+
+
+def has_run(run_dir):
+    return os.path.exists(os.path.join(run_dir, RECORDS_FILE))
+
+
+def iter_records(run_dir):
+    """Yield the run's records in order without loading the whole file."""
+    records_path = os.path.join(run_dir, RECORDS_FILE)
+    if not os.path.exists(records_path):
+        # Runs written before the compact format
+        with open(os.path.join(run_dir, LEGACY_RECORDS_FILE), 'r') as f:
+            yield from json.load(f)
+        return
+    with open(records_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_records(run_dir):
+    return list(iter_records(run_dir))
+
+
+class PhotoBlob:
+    """Read-only, memory-mapped view of a run's ``photos.bin``."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap refuses empty files (a run without any photos)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._map) if self._map is not None else memoryview(b'')
+
+    def get(self, entry):
+        """Zero-copy slice for a record's ``photo`` entry, or None."""
+        if not entry:
+            return None
+        offset, length = entry
+        return self._view[offset:offset + length]
+
+
+@lru_cache(maxsize=4)
+def _open_photo_blob(path, mtime_ns, size):
+    return PhotoBlob(path)
+
+
+def open_photo_blob(run_dir):
+    """Per-process PhotoBlob for ``run_dir`` (None for legacy runs).
+
+    Keyed by the file's mtime and size too, so a roster re-submitted into
+    the same run directory is never read through a stale mapping.
+    """
+    path = os.path.join(run_dir, PHOTOS_FILE)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return _open_photo_blob(path, st.st_mtime_ns, st.st_size)
@@ -1,174 +1,525 @@
 import os
-import pandas as pd
 import zipfile
 import re
 import io
+import csv
+import datetime
+import itertools
+import multiprocessing
 import shutil
 import base64
-from PIL import Image
+import collections
+import concurrent.futures
+import threading
+from PIL import Image, ImageOps
+
+from logs import get_logger
+from metrics import INGEST_STAGE_SECONDS, PHOTOS
+from photo_fetcher import extract_drive_file_id, get_default_fetcher
+
+log = get_logger('ingest')
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+# Members larger than this are never read into memory (zip-bomb / RAW dump guard)
+MAX_PHOTO_BYTES = 50 * 1024 * 1024
+# Roster rows parsed (and photo-matched) per batch by the streaming readers
+DEFAULT_BATCH_SIZE = 1000
+# Consecutive PDF pages parsed per pool task (see iter_pdf_page_rows)
+PDF_PAGES_PER_SHARD = 8
+# Parser processes shared by all PDF uploads in a process (PDF_PARSE_WORKERS overrides)
+DEFAULT_PDF_PARSE_WORKERS = 2
+# Width photos are capped at when no template slot is given
+MAX_PHOTO_WIDTH = 800
+PHOTO_QUALITY = 85
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+class PhotoIndex:
+    """Match index over photo filenames, built once per process_images call.
+
+    Keeps the old linear-scan semantics (first photo in archive order whose
+    stem contains the roll / cleaned name) but finds candidates through
+    trigram postings instead of re-running regexes over every filename for
+    every row.
+
+    Sources are either bytes, a ZipInfo from ``zip_file``'s central directory
+    or a file path; the latter two are only read when a row matches them.
+    """
+    NGRAM = 3
+
+    def __init__(self, raw_photos, zip_file=None):
+        self.raw_photos = raw_photos # filename -> bytes | ZipInfo | path
+        self.zip_file = zip_file
+        self.names = list(raw_photos)
+        self.stems = [os.path.splitext(f)[0].upper() for f in self.names]
+        self.clean_stems = [re.sub(r'[^A-Z0-9]', '', s) for s in self.stems]
+        # Whole-token lookup, used to flag which ambiguous candidates are exact roll hits
+        self.roll_tokens = {}
+        for idx, stem in enumerate(self.stems):
+            for token in set(re.split(r'[^A-Z0-9]+', stem)):
+                if token: self.roll_tokens.setdefault(token, []).append(idx)
+        self._stem_grams = self._build_grams(self.stems)
+        self._clean_grams = self._build_grams(self.clean_stems)
+
+    def _build_grams(self, texts):
+        grams = {}
+        n = self.NGRAM
+        for idx, text in enumerate(texts):
+            for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+                grams.setdefault(gram, set()).add(idx)
+        return grams
+
+    def _substring_hits(self, grams, texts, query):
+        """All indices (in archive order) whose text contains ``query``."""
+        n = self.NGRAM
+        if len(query) < n:
+            return [i for i, t in enumerate(texts) if query in t]
+        postings = []
+        for gram in {query[i:i + n] for i in range(len(query) - n + 1)}:
+            posting = grams.get(gram)
+            if not posting: return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return sorted(i for i in candidates if query in texts[i])
+
+    def match_roll(self, roll):
+        return self._substring_hits(self._stem_grams, self.stems, roll)
+
+    def match_name(self, clean_name):
+        hits = self._substring_hits(self._clean_grams, self.clean_stems, clean_name)
+        return [i for i in hits if self.size(i)]
+
+    def size(self, idx):
+        source = self.raw_photos[self.names[idx]]
+        if isinstance(source, zipfile.ZipInfo): return source.file_size
+        if isinstance(source, str): return os.path.getsize(source)
+        return len(source)
+
+    def read(self, idx):
+        """Bytes of photo ``idx``, decompressed/read from disk on demand."""
+        source = self.raw_photos[self.names[idx]]
+        if isinstance(source, bytes): return source
+        if self.size(idx) > MAX_PHOTO_BYTES:
+            log.warning("Skipping oversized photo %s", self.names[idx])
+            return b''
+        if isinstance(source, zipfile.ZipInfo):
+            return self.zip_file.read(source)
+        with open(source, 'rb') as f:
+            return f.read()
+
+def fit_photo(data, slot=None, quality=PHOTO_QUALITY):
+    """Decode, orient and fit a photo in one pass; returns JPEG bytes.
+
+    ``slot`` is a pixel box (render_engine.photo_slot): the photo is cropped
+    and resized straight to it with the template's preserveAspectRatio fit.
+    Without one it is only capped at MAX_PHOTO_WIDTH. JPEGs are decoded in
+    draft mode, i.e. at the smallest 1/2, 1/4 or 1/8 DCT scale still at
+    least as large as the result, so a 12 MP phone photo is never fully
+    decoded; other formats are box-reduced before the final LANCZOS pass.
+    """
+    img = Image.open(io.BytesIO(data))
+    transposed = img.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS
+    width, height = img.size[::-1] if transposed else img.size
+    if slot:
+        target = (slot['width'], slot['height'])
+        fit, (ax, ay) = slot.get('fit', 'slice'), slot.get('align', (0.5, 0.5))
+    else:
+        target = (min(width, MAX_PHOTO_WIDTH), max(1, int(height * min(1, MAX_PHOTO_WIDTH / width))))
+        fit, (ax, ay) = 'none', (0.5, 0.5)
+    if fit == 'meet':
+        scale = min(target[0] / width, target[1] / height)
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    else: # slice / none: every target pixel needs source detail
+        scale = max(target[0] / width, target[1] / height)
+
+    if scale < 1:
+        # Requested in stored (pre-EXIF) orientation; draft only ever scales down
+        draft_size = (int(width * scale) + 1, int(height * scale) + 1)
+        img.draft('RGB', draft_size[::-1] if transposed else draft_size)
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    box = (0, 0) + img.size
+    if fit == 'slice':
+        # Crop to the slot's aspect ratio, positioned like SVG xMidYMid etc.
+        w, h = img.size
+        crop_w, crop_h = min(w, h * target[0] / target[1]), min(h, w * target[1] / target[0])
+        left, top = (w - crop_w) * ax, (h - crop_h) * ay
+        box = (left, top, left + crop_w, top + crop_h)
+    if img.size != target or box != (0, 0) + img.size:
+        img = img.resize(target, Image.Resampling.LANCZOS, box=box, reducing_gap=3.0)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+def normalize_column(header):
+    """Standard key ('name', 'roll', 'image') for a roster column, else the cleaned header."""
+    col = str(header).strip().lower()
+    if 'roll' in col or 'registration' in col:
+        return 'roll'
+    elif 'name' in col and 'file' not in col: # avoid 'filename'
+        return 'name'
+    elif any(x in col for x in ['image', 'photo', 'pic']):
+        return 'image'
+    return col
+
+def _clean_value(value):
+    if value is None or (isinstance(value, float) and value != value): # None / NaN
+        return ''
+    if isinstance(value, datetime.datetime):
+        if value.time() != datetime.time():
+            return str(value)
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return value.strftime('%d-%m-%Y') # the certificate's date format
+    if isinstance(value, datetime.time):
+        return str(value)
+    return value
+
+def _rows_to_records(header, rows):
+    """Yield one record dict per non-blank row, keyed by normalized column names."""
+    keys = []
+    for idx, h in enumerate(header):
+        key = normalize_column(h if h is not None else f"unnamed: {idx}")
+        if key in keys:
+            # e.g. 'Student Name' and 'Father Name': the first column keeps 'name'
+            key = str(h).strip().lower()
+        keys.append(key)
+    width = len(keys)
+    for row in rows:
+        values = [_clean_value(v) for v in itertools.islice(row, width)]
+        if not any(v != '' for v in values):
+            continue
+        values.extend([''] * (width - len(values)))
+        record = dict(zip(keys, values))
+        # Blank roll/name cells count as missing, like an absent column ('N/A' / 'Unknown')
+        for key in ('roll', 'name'):
+            if str(record.get(key, 'x')).strip() == '':
+                del record[key]
+        yield record
+
+def _iter_csv_rows(file_path):
+    # utf-8-sig: spreadsheet exports often start with a BOM
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is not None:
+            yield from _rows_to_records(header, reader)
+
+def _iter_xlsx_rows(file_path):
+    import openpyxl
+    # read_only streams rows out of the sheet XML instead of building every cell up front
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is not None:
+            yield from _rows_to_records(header, rows)
+    finally:
+        wb.close()
+
+def _iter_xls_rows(file_path):
+    # Legacy binary workbooks: no streaming reader, pandas (xlrd) loads the sheet
+    import pandas as pd
+    df = pd.read_excel(file_path, dtype=object)
+    yield from _rows_to_records(df.columns, df.itertuples(index=False, name=None))
+
+def _pdf_page_rows(file_path, page_numbers):
+    """Table rows of each page in ``page_numbers`` (one list per page). Runs in a worker."""
+    import pdfplumber
+    pages = []
+    with pdfplumber.open(file_path) as pdf:
+        for number in page_numbers:
+            page = pdf.pages[number]
+            rows = []
+            for table in page.extract_tables():
+                for row in table:
+                    # Simple heuristic: Row must have at least 2 non-empty cells to be data
+                    if len([c for c in row if c]) >= 2:
+                        rows.append(row)
+            pages.append(rows)
+            page.close() # drop the page's parsed layout before the next one
+    return pages
+
+def pdf_parse_workers():
+    return int(os.environ.get('PDF_PARSE_WORKERS', 0)) or DEFAULT_PDF_PARSE_WORKERS
+
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_pdf_pool = None
+_pdf_pool_pid = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    """Process-wide pool of ``pdf_parse_workers()`` parsers, shared by every upload."""
+    global _pdf_pool, _pdf_pool_pid
+    with _pdf_pool_lock:
+        # A pool must not cross a fork (gunicorn preload)
+        if _pdf_pool is None or _pdf_pool_pid != os.getpid():
+            # Never fork this (threaded) web worker: a lock another thread holds would be copied held
+            _pdf_pool = concurrent.futures.ProcessPoolExecutor(max_workers=pdf_parse_workers(),
+                                                               mp_context=multiprocessing.get_context(_START_METHOD))
+            _pdf_pool_pid = os.getpid()
+        return _pdf_pool
+
+def iter_pdf_page_rows(file_path, workers=None, pages_per_shard=PDF_PAGES_PER_SHARD):
+    """Yield each page's table rows, in page order, as soon as that page is parsed.
+
+    Long PDFs are split into shards of ``pages_per_shard`` consecutive pages
+    that the shared parser pool works through in parallel (``extract_tables``
+    is pure Python and CPU-bound), at most ``workers`` shards in flight per
+    upload; shards are yielded in order, so page N is out as soon as pages
+    0..N are done. Short PDFs, or ``workers=1``, stay in this process.
+    """
+    import pdfplumber
+    with pdfplumber.open(file_path) as pdf:
+        page_count = len(pdf.pages)
+    shards = [range(start, min(start + pages_per_shard, page_count))
+              for start in range(0, page_count, pages_per_shard)]
+    workers = min(workers or pdf_parse_workers(), len(shards))
+    if workers <= 1:
+        for shard in shards:
+            yield from _pdf_page_rows(file_path, shard)
+        return
+
+    pool = _get_pdf_pool()
+    pending = collections.deque()
+    shards = iter(shards)
+    try:
+        for shard in itertools.islice(shards, workers):
+            pending.append(pool.submit(_pdf_page_rows, file_path, shard))
+        while pending:
+            pages = pending.popleft().result()
+            for shard in itertools.islice(shards, 1):
+                pending.append(pool.submit(_pdf_page_rows, file_path, shard))
+            yield from pages
+    finally:
+        # Also reached when the consumer stops early: skip shards nobody will read
+        for future in pending:
+            future.cancel()
+
+def _iter_pdf_rows(file_path, workers=None):
+    """Extract table rows from a PDF using pdfplumber, streaming them page by page."""
+    pages = iter_pdf_page_rows(file_path, workers)
+    first = []
+    for first in pages:
+        if first: break
+    if not first:
+        raise ValueError("No tabular data found in PDF")
+
+    # Header detection runs once, on the first data row of the document, and
+    # applies to every page: assume it is a header if it contains 'Name' or 'Roll'
+    header = [str(h).strip() for h in first[0]]
+    is_header = any('NAME' in h.upper() for h in header) or any('ROLL' in h.upper() for h in header)
+    if is_header:
+        # Tables that span pages usually repeat the header row on each page
+        rows = (row for page in itertools.chain([first[1:]], pages) for row in page
+                if [str(c).strip() for c in row] != header)
+        return _rows_to_records(header, rows)
+    # Generic numbered columns; nothing maps to name/roll
+    rows = itertools.chain.from_iterable(itertools.chain([first], pages))
+    return _rows_to_records([str(i) for i in range(len(first[0]))], rows)
+
+TABLE_READERS = {
+    '.csv': _iter_csv_rows,
+    '.xlsx': _iter_xlsx_rows,
+    '.xlsm': _iter_xlsx_rows,
+    '.xls': _iter_xls_rows,
+    '.pdf': _iter_pdf_rows,
+}
+
+def iter_table_batches(file_path, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield lists of up to ``batch_size`` column-normalized records from a roster file.
+
+    CSV goes through the csv module and XLSX through openpyxl's read-only
+    mode, so memory is bounded by the batch rather than the file. Raises
+    ValueError for unsupported or unreadable files.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    reader = TABLE_READERS.get(ext)
+    if reader is None:
+        raise ValueError(f"Unsupported file format: {ext}")
+    stage = 'parse_' + ext.lstrip('.')
+    rows = None
+    while True:
+        with INGEST_STAGE_SECONDS.time(stage=stage):
+            try:
+                if rows is None:
+                    rows = iter(reader(file_path))
+                batch = list(itertools.islice(rows, batch_size))
+            except ValueError:
+                raise
+            except Exception as e:
+                raise ValueError(f"Could not read {ext} file: {e}") from e
+        if not batch:
+            return
+        yield batch
 
-import requests
 
 class SmartIngestor:
-    def __init__(self):
-        self.data_df = None
-        self.photos_map = {} # {normalized_name: base64_data}
+    def __init__(self, fetcher=None, max_workers=20, photo_slot=None):
+        self.rows = None # normalized record dicts, see process_data_file
+        self.photo_slot = photo_slot # pixel box photos are fitted to, see fit_photo
+        self.photos_map = {} # {normalized_name: jpeg_bytes}
+        self.ambiguous_matches = [] # rows whose roll/name matched several photos, see _note_ambiguity
+        self._fetcher = fetcher
+        self.max_workers = max_workers
+
+    @property
+    def fetcher(self):
+        """Shared pooled/cached downloader; per-host limits cap actual concurrency."""
+        # Built on the first Drive link, so most uploads never import requests
+        if self._fetcher is None:
+            self._fetcher = get_default_fetcher()
+        return self._fetcher
 
     def process_data_file(self, file_path):
-        """Intelligently parse CSV, Excel, or PDF into a DataFrame."""
-        ext = os.path.splitext(file_path)[1].lower()
-        
+        """Parse a CSV, Excel, or PDF roster into normalized records, all in memory.
+
+        Large rosters should go through iter_record_batches instead.
+        """
         try:
-            if ext == '.csv':
-                self.data_df = pd.read_csv(file_path)
-            elif ext in ['.xlsx', '.xls']:
-                self.data_df = pd.read_excel(file_path)
-            elif ext == '.pdf':
-                self.data_df = self._parse_pdf(file_path)
-            else:
-                raise ValueError(f"Unsupported file format: {ext}")
-            
-            # Normalize columns
-            self._normalize_columns()
-            print(f"DEBUG INGESTOR: Columns after norm: {self.data_df.columns}")
-            print(f"DEBUG INGESTOR: First record: {self.data_df.iloc[0].to_dict() if not self.data_df.empty else 'EMPTY'}")
-            return True, f"Successfully loaded {len(self.data_df)} records."
+            self.rows = [rec for batch in iter_table_batches(file_path) for rec in batch]
+            log.debug("Columns after norm: %s", list(self.rows[0]) if self.rows else [])
+            return True, f"Successfully loaded {len(self.rows)} records."
         except Exception as e:
             return False, str(e)
 
-    def _parse_pdf(self, file_path):
-        """Extract table data from PDF using pdfplumber."""
-        import pdfplumber
-        data = []
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                tables = page.extract_tables()
-                for table in tables:
-                    for row in table:
-                        # Simple heuristic: Row must have at least 2 non-empty cells to be data
-                        if len([c for c in row if c]) >= 2:
-                            data.append(row)
-        
-        if not data:
-            raise ValueError("No tabular data found in PDF")
+    def process_images(self, zip_path=None, loose_folder=None, lazy=True):
+        """Load images and map them to students using parallel processing.
 
-        # Assume first row is header if it looks like one (contains 'Name' or 'Roll')
-        header = data[0]
-        # Clean header
-        header = [str(h).strip() for h in header]
-        
-        # Check if first row is actually header
-        is_header = any('NAME' in h.upper() for h in header) or any('ROLL' in h.upper() for h in header)
-        
-        if is_header:
-            df = pd.DataFrame(data[1:], columns=header)
-        else:
-            # Generate generic columns
-            df = pd.DataFrame(data)
-            # Try to identify columns by content? For now leave generic
-        
-        return df
+        With ``lazy`` (default) only the ZIP central directory / folder listing
+        is indexed; a photo is read and decoded only when a row matches it, so
+        memory stays bounded by the worker count, not the archive size.
+        """
+        # Match to Data
+        if self.rows is None: return "No data loaded yet."
 
-    def _normalize_columns(self):
-        """Standardize column names to 'name', 'roll', 'image'."""
-        if self.data_df is None: return
-        
-        # Lowercase and strip
-        self.data_df.columns = [str(c).strip().lower() for c in self.data_df.columns]
-        
-        # Rename common variations
-        rename_map = {}
-        for col in self.data_df.columns:
-            if 'roll' in col or 'registration' in col:
-                rename_map[col] = 'roll'
-            elif 'name' in col and 'file' not in col: # avoid 'filename'
-                rename_map[col] = 'name'
-            elif any(x in col for x in ['image', 'photo', 'pic']):
-                rename_map[col] = 'image'
-        
-        if rename_map:
-            self.data_df.rename(columns=rename_map, inplace=True)
-            
-        # Ensure name and roll exist
-        if 'name' not in self.data_df.columns:
-            # Heuristic: First column with string text might be name?
-            # For safety, just create Unknown if missing
-            pass
-            
-    def process_images(self, zip_path=None, loose_folder=None):
-        """Load images and map them to students using parallel processing."""
-        import concurrent.futures
-        
-        raw_photos = {} # filename -> bytes
+        zf = zipfile.ZipFile(zip_path, 'r') if zip_path and os.path.exists(zip_path) else None
+        try:
+            photo_index = self._index_photos(zf, loose_folder, lazy)
+            self.ambiguous_matches = []
+            log.debug("Starting parallel image processing")
+            # We prefer ThreadPool for network operations (downloading images)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                matches = self._match_rows(self.rows, photo_index, executor)
+        finally:
+            if zf: zf.close()
+
+        for match in matches:
+            if match:
+                key, jpeg = match
+                self.photos_map[key] = jpeg
+        matched_count = sum(1 for m in matches if m)
+        log.info("Matched photos for %d of %d rows", matched_count, len(self.rows))
+        if self.ambiguous_matches:
+            log.info("%d rows matched more than one photo (first match used)", len(self.ambiguous_matches))
+        return matched_count
+
+    def iter_record_batches(self, file_path, zip_path=None, loose_folder=None, batch_size=DEFAULT_BATCH_SIZE):
+        """Parse, photo-match and yield the roster as lists of (record, photo_bytes).
+
+        Nothing is kept between batches, so memory stays flat however long the
+        roster is, and a consumer (run_store.write_run, render_engine.render_many)
+        starts on the first batch while the rest of the file is still being
+        read. Photos are matched only when a ZIP or folder is given, as with
+        process_images. Raises ValueError for unsupported or unreadable files.
+        """
+        zf = zipfile.ZipFile(zip_path, 'r') if zip_path and os.path.exists(zip_path) else None
+        try:
+            photo_index = self._index_photos(zf, loose_folder) if zf or loose_folder else None
+            self.ambiguous_matches = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for batch in iter_table_batches(file_path, batch_size):
+                    if photo_index is None:
+                        yield [(rec, None) for rec in batch]
+                        continue
+                    matches = self._match_rows(batch, photo_index, executor)
+                    yield [(rec, match[1] if match else None) for rec, match in zip(batch, matches)]
+        finally:
+            if zf: zf.close()
+
+    def _index_photos(self, zf, loose_folder, lazy=True):
+        raw_photos = {} # filename -> bytes (eager) or ZipInfo/path (lazy)
         
         # Load from ZIP
-        if zip_path and os.path.exists(zip_path):
-            with zipfile.ZipFile(zip_path, 'r') as zf:
-                for file in zf.namelist():
-                    if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                        name = os.path.basename(file)
-                        raw_photos[name] = zf.read(file)
+        if zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    name = os.path.basename(info.filename)
+                    raw_photos[name] = info if lazy else zf.read(info)
                         
         # Load from Folder
         if loose_folder and os.path.exists(loose_folder):
             for file in os.listdir(loose_folder):
-                 if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                     with open(os.path.join(loose_folder, file), 'rb') as f:
-                        raw_photos[file] = f.read()
+                 if file.lower().endswith(IMAGE_EXTENSIONS):
+                     path = os.path.join(loose_folder, file)
+                     if lazy:
+                        raw_photos[file] = path
+                     else:
+                        with open(path, 'rb') as f:
+                            raw_photos[file] = f.read()
+        return PhotoIndex(raw_photos, zf)
 
-        # Match to Data
-        if self.data_df is None: return "No data loaded yet."
-        
-        matched_count = 0
-        
-        # Parallel Execution for per-row processing
-        # We prefer ThreadPool for network operations (downloading images)
-        print("DEBUG: Starting parallel image processing...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-            # Create list of rows to avoid pandas iterrows overhead in thread
-            rows = [row for _, row in self.data_df.iterrows()]
-            
-            # Submit all tasks
-            future_to_row = {executor.submit(self._process_single_row, row, raw_photos): row for row in rows}
-            
-            for future in concurrent.futures.as_completed(future_to_row):
-                try:
-                    result = future.result()
-                    if result:
-                        key, b64 = result
-                        self.photos_map[key] = b64
-                        matched_count += 1
-                except Exception as exc:
-                    print(f"DEBUG: Row processing generated an exception: {exc}")
-
-        print(f"DEBUG: Parallel processing matched {matched_count} images.")
-        return matched_count
+    def _match_rows(self, rows, photo_index, executor):
+        """[(key, jpeg) or None] per row, in row order."""
+        ambiguous_before = len(self.ambiguous_matches)
+        with INGEST_STAGE_SECONDS.time(stage='match_photos'):
+            matches = list(executor.map(lambda row: self._process_row_safely(row, photo_index), rows))
+        matched_count = sum(1 for m in matches if m)
+        PHOTOS.inc(matched_count, result='matched')
+        PHOTOS.inc(len(rows) - matched_count, result='missing')
+        PHOTOS.inc(len(self.ambiguous_matches) - ambiguous_before, result='ambiguous')
+        return matches
+
+    def _process_row_safely(self, row, photo_index):
+        try:
+            return self._process_single_row(row, photo_index)
+        except Exception as exc:
+            log.warning("Row processing generated an exception: %s", exc)
+            return None
+
+    def _note_ambiguity(self, row, roll, name, match_type, hits, photo_index):
+        """Record a row whose first photo match was picked from several candidates.
 
-    def _process_single_row(self, row, raw_photos):
+        The entry keeps the ``record`` itself, so callers can point at the
+        certificate it becomes (e.g. the preview flags it for review).
+        """
+        if len(hits) < 2: return
+        exact = photo_index.roll_tokens.get(roll, []) if match_type == 'roll' else []
+        self.ambiguous_matches.append({
+            'record': row,
+            'roll': roll,
+            'name': name,
+            'match_type': match_type,
+            'chosen': photo_index.names[hits[0]],
+            'candidates': [photo_index.names[i] for i in hits],
+            'exact_token_matches': [photo_index.names[i] for i in exact],
+        })
+
+    def _process_single_row(self, row, photo_index):
         """Helper to process a single row: find locally or download."""
         roll = str(row.get('roll', 'N/A')).strip().upper()
         name = str(row.get('name', 'Unknown')).strip().upper()
         
         photo_bytes = None
         
-        # 1. Exact Roll Match (in local raw_photos)
-        if roll != 'N/A':
-            for fname, pbytes in raw_photos.items():
-                base = os.path.splitext(fname)[0].upper()
-                if roll in base:
-                    photo_bytes = pbytes
-                    break
+        # 1. Exact Roll Match (in local photos); an empty roll would match every photo
+        if roll and roll != 'N/A':
+            hits = photo_index.match_roll(roll)
+            if hits:
+                photo_bytes = photo_index.read(hits[0])
+                self._note_ambiguity(row, roll, name, 'roll', hits, photo_index)
         
-        # 2. Exact Name Match (in local raw_photos)
+        # 2. Exact Name Match (in local photos)
         if not photo_bytes:
-             for fname, pbytes in raw_photos.items():
-                if not pbytes: continue
-                # clean filename
-                clean_fname = re.sub(r'[^A-Z0-9]', '', os.path.splitext(fname)[0].upper())
-                clean_name = re.sub(r'[^A-Z0-9]', '', name)
-                if clean_name and clean_name in clean_fname and len(clean_name) > 3:
-                    photo_bytes = pbytes
-                    break
+            clean_name = re.sub(r'[^A-Z0-9]', '', name)
+            if clean_name and len(clean_name) > 3:
+                hits = photo_index.match_name(clean_name)
+                if hits:
+                    photo_bytes = photo_index.read(hits[0])
+                    self._note_ambiguity(row, roll, name, 'name', hits, photo_index)
         
         # 3. Image URL/Path in CSV (Google Drive logic)
         # This is the slow part that benefits from threads
@@ -176,68 +527,32 @@ class SmartIngestor:
             img_ref = str(row['image'])
             if 'http' in img_ref:
                 # Check for Google Drive URL
-                file_id = None
-                if 'drive.google.com' in img_ref:
-                    # Extract ID
-                    patterns = [
-                        r'id=([a-zA-Z0-9_-]+)',
-                        r'/d/([a-zA-Z0-9_-]+)',
-                        r'/open\?id=([a-zA-Z0-9_-]+)'
-                    ]
-                    for p in patterns:
-                        match = re.search(p, img_ref)
-                        if match:
-                            file_id = match.group(1)
-                            break
-                
+                file_id = extract_drive_file_id(img_ref)
                 if file_id:
-                    download_url = f'https://drive.google.com/uc?export=download&id={file_id}'
-                    try:
-                        # Shorter timeout for bulk processing to avoid hanging everything
-                        response = requests.get(download_url, timeout=5)
-                        if response.status_code == 200:
-                            photo_bytes = response.content
-                    except Exception as e:
-                        print(f"DEBUG: Exception downloading image for {name}: {e}")
+                    photo_bytes = self.fetcher.fetch_drive(file_id)
         
         if photo_bytes:
-            b64 = self._bytes_to_base64(photo_bytes)
-            if b64:
+            jpeg = self._normalize_photo(photo_bytes)
+            if jpeg:
                 # Store in map using Roll (preferred) or Name
                 key = roll if roll != 'N/A' else name
-                return (key, b64)
+                return (key, jpeg)
         return None
 
-    def _bytes_to_base64(self, data):
+    def _normalize_photo(self, data):
+        """JPEG bytes fitted to the photo slot (see fit_photo), or None if unreadable."""
         try:
-             # Validate image
-             img = Image.open(io.BytesIO(data))
-             if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
-             buf = io.BytesIO()
-             # Resize if too huge to save memory
-             if img.width > 800:
-                 ratio = 800 / img.width
-                 new_h = int(img.height * ratio)
-                 img = img.resize((800, new_h), Image.Resampling.LANCZOS)
-                 
-             img.save(buf, format='JPEG', quality=85) # Convert to JPEG 85 to save zip size
-             return f"data:image/jpeg;base64,{base64.b64encode(buf.getvalue()).decode()}"
+            return fit_photo(data, self.photo_slot)
         except Exception as e:
-            # print(f"DEBUG: Image validation failed: {e}")
+            log.debug("Image validation failed: %s", e)
             return None
 
-    def get_records(self):
-        """Return list of dicts with integrated photo data."""
-        records = []
-        if self.data_df is None: return []
+    def iter_records(self):
+        """Yield (record, photo_bytes) per row; photo_bytes is JPEG data or None."""
+        if self.rows is None: return
         
-        for _, row in self.data_df.iterrows():
-            rec = row.to_dict()
-            # Clean keys
-            clean_rec = {}
-            for k,v in rec.items():
-                clean_rec[k.lower()] = v
-                
+        for row in self.rows:
+            clean_rec = dict(row)
             roll = str(clean_rec.get('roll', 'N/A')).strip().upper()
             name = str(clean_rec.get('name', 'Unknown')).strip().upper()
             
@@ -245,8 +560,13 @@ class SmartIngestor:
             photo = self.photos_map.get(roll)
             if not photo:
                 photo = self.photos_map.get(name)
-            
-            clean_rec['photo_base64'] = photo if photo else ""
+            yield clean_rec, photo
+
+    def get_records(self):
+        """Return list of dicts with integrated photo data."""
+        records = []
+        for clean_rec, photo in self.iter_records():
+            clean_rec['photo_base64'] = f"data:image/jpeg;base64,{base64.b64encode(photo).decode()}" if photo else ""
             records.append(clean_rec)
         return records
 
@@ -0,0 +1,166 @@
+"""Synthetic rosters and photo ZIPs for benchmarking and load testing.
+
+Rosters have a ``Roll No`` and a ``Student Name`` column, as real uploads
+do, and can be written as CSV, XLSX or a ruled-table PDF that the
+ingestor's pdfplumber path can read back. Name lengths follow a chosen
+distribution, so the wrapping and font-size branches of the template are
+all exercised. Photo ZIPs contain one distinct image per student, named by
+roll number.
+
+    python synthetic_data.py --rows 1000 --out bench_data --names mixed --photo_size 600x800
+"""
+import argparse
+import csv
+import os
+import random
+import zipfile
+from io import BytesIO
+
+from PIL import Image
+
+_FIRST = ['AARAV', 'VIHAAN', 'ADITYA', 'SAI', 'ARJUN', 'KRISHNA', 'ISHAAN', 'ANANYA', 'DIYA', 'SAANVI',
+          'LAKSHMI', 'PRIYA', 'MEERA', 'RAHUL', 'VENKATA', 'SRINIVASA', 'HARSHA', 'KAVYA', 'NIKHIL', 'POOJA']
+_LAST = ['REDDY', 'SHARMA', 'RAO', 'NAIDU', 'VARMA', 'KUMAR', 'PATEL', 'IYER', 'CHOWDARY', 'GUPTA',
+         'SUBRAMANIAN', 'VENKATARAMAN', 'BHATTACHARYA', 'KRISHNAMURTHY', 'RAMACHANDRAN']
+
+# (min, max) characters; 'mixed' draws from these with the given weights
+NAME_LENGTHS = {
+    'short': (6, 15),
+    'medium': (16, 30),
+    'long': (31, 55),
+}
+MIXED_WEIGHTS = {'short': 0.5, 'medium': 0.35, 'long': 0.15}
+
+
+def _make_name(rng, lo, hi):
+    target = rng.randint(lo, hi)
+    parts = [rng.choice(_FIRST)]
+    while len(' '.join(parts)) < target:
+        parts.append(rng.choice(_LAST if len(parts) > 1 else _FIRST + _LAST))
+    name = ' '.join(parts)
+    # Trim whole words that overshoot, but never below one word
+    while len(name) > hi and len(parts) > 1:
+        parts.pop()
+        name = ' '.join(parts)
+    return name
+
+
+def synthetic_roster(rows, names='mixed', seed=0):
+    """List of {'roll', 'name'} dicts with names drawn from ``names`` lengths."""
+    rng = random.Random(seed)
+    kinds = list(MIXED_WEIGHTS) if names == 'mixed' else [names]
+    weights = [MIXED_WEIGHTS[k] for k in kinds] if names == 'mixed' else None
+    roster = []
+    for i in range(rows):
+        kind = rng.choices(kinds, weights)[0]
+        roster.append({'roll': f"22A91A{i:05d}", 'name': _make_name(rng, *NAME_LENGTHS[kind])})
+    return roster
+
+
+def write_csv(path, roster):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Roll No', 'Student Name'])
+        for rec in roster:
+            writer.writerow([rec['roll'], rec['name']])
+    return path
+
+
+def write_xlsx(path, roster):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Roster')
+    ws.append(['Roll No', 'Student Name'])
+    for rec in roster:
+        ws.append([rec['roll'], rec['name']])
+    wb.save(path)
+    return path
+
+
+def write_pdf(path, roster, rows_per_page=40):
+    """Ruled table, one header row per page (what pdfplumber's table finder expects)."""
+    import cairocffi as cairo
+    width, height = 595, 842  # A4 portrait, points
+    left, top, row_h = 40, 40, 19
+    col_x = [left, left + 150, width - left]
+    surface = cairo.PDFSurface(path, width, height)
+    ctx = cairo.Context(surface)
+    ctx.select_font_face('Sans')
+    ctx.set_font_size(9)
+    ctx.set_line_width(0.5)
+    for start in range(0, max(len(roster), 1), rows_per_page):
+        page = [('Roll No', 'Student Name')] + [(r['roll'], r['name']) for r in roster[start:start + rows_per_page]]
+        for i, (roll, name) in enumerate(page):
+            y = top + i * row_h
+            for x, text in zip(col_x, (roll, name)):
+                ctx.move_to(x + 4, y + 13)
+                ctx.show_text(text)
+        bottom = top + len(page) * row_h
+        for i in range(len(page) + 1):
+            ctx.move_to(col_x[0], top + i * row_h)
+            ctx.line_to(col_x[-1], top + i * row_h)
+        for x in col_x:
+            ctx.move_to(x, top)
+            ctx.line_to(x, bottom)
+        ctx.stroke()
+        surface.show_page()
+    surface.finish()
+    return path
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx, 'pdf': write_pdf}
+
+
+def synthetic_photo(size, seed, fmt='JPEG', quality=90):
+    """Encoded image of ``size`` with a per-student colour and noise pattern."""
+    rng = random.Random(seed)
+    noise = Image.effect_noise(size, 40).convert('L')
+    tint = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    img = Image.merge('RGB', [Image.blend(band, noise, 0.35) for band in tint.split()])
+    buf = BytesIO()
+    img.save(buf, format=fmt, quality=quality)
+    return buf.getvalue()
+
+
+def write_photo_zip(path, roster, size=(600, 800), coverage=1.0, fmt='JPEG', seed=0):
+    """ZIP of one photo per student (``coverage`` = fraction of students with one)."""
+    rng = random.Random(seed)
+    ext = '.png' if fmt == 'PNG' else '.jpg'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        for i, rec in enumerate(roster):
+            if rng.random() < coverage:
+                zf.writestr(f"photos/{rec['roll']}{ext}", synthetic_photo(size, seed + i, fmt))
+    return path
+
+
+def parse_size(value):
+    w, _, h = value.lower().partition('x')
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic rosters and photo ZIPs')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--out', default='bench_data', help='Output directory')
+    parser.add_argument('--formats', default='csv,xlsx,pdf', help='Roster formats to write')
+    parser.add_argument('--names', choices=['mixed'] + sorted(NAME_LENGTHS), default='mixed',
+                        help='Name length distribution')
+    parser.add_argument('--photo_size', default='600x800', help='WIDTHxHEIGHT of each photo')
+    parser.add_argument('--photo_format', choices=['JPEG', 'PNG'], default='JPEG')
+    parser.add_argument('--coverage', type=float, default=1.0, help='Fraction of students with a photo')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    roster = synthetic_roster(args.rows, args.names, args.seed)
+    for fmt in args.formats.split(','):
+        path = WRITERS[fmt](os.path.join(args.out, f"roster_{args.rows}.{fmt}"), roster)
+        print(f"Wrote {path}")
+    if args.coverage > 0:
+        path = write_photo_zip(os.path.join(args.out, f"photos_{args.rows}.zip"), roster,
+                               parse_size(args.photo_size), args.coverage, args.photo_format, args.seed)
+        print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
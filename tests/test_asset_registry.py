@@ -0,0 +1,68 @@
+import os
+import sys
+from io import BytesIO
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asset_registry import AssetRegistry
+from run_store import open_photo_blob, write_run
+
+
+def _jpeg(color='red'):
+    buf = BytesIO()
+    Image.new('RGB', (30, 40), color).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def test_blob_photo_through_url_fetcher(tmp_path):
+    data = _jpeg()
+    write_run(str(tmp_path), [({'name': 'A', 'roll': '1'}, data)])
+    blob = open_photo_blob(str(tmp_path))
+    photo = blob.get([0, len(data)])
+    assert isinstance(photo, memoryview)
+
+    registry = AssetRegistry()
+    ref = registry.put_bytes(photo)
+    png = registry.url_fetcher(ref, 'image/*')
+    assert png.startswith(b'\x89PNG')
+    assert Image.open(BytesIO(png)).size == (30, 40)
+
+
+def test_shared_photo_survives_first_release():
+    registry = AssetRegistry()
+    first = registry.put_bytes(_jpeg())
+    second = registry.put_bytes(_jpeg())  # same content, e.g. another request
+    assert first == second
+
+    registry.release(first)
+    assert registry.url_fetcher(second, 'image/*').startswith(b'\x89PNG')
+    registry.release(second)
+    assert not registry._sources
+
+
+def test_raw_photo_fitted_to_slot():
+    buf = BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = 6  # stored landscape, displayed portrait
+    Image.new('RGB', (2000, 1500), 'blue').save(buf, format='JPEG', exif=exif)
+
+    registry = AssetRegistry()
+    ref = registry.put_bytes(buf.getvalue())
+    fitted = registry.get_fitted(ref, 120, 160, fit='slice')
+    assert fitted.size == (120, 160)
+    assert not registry._images  # the draft decode is not cached for other slots
+    assert registry.get_image(ref).size == (1500, 2000)
+
+
+def test_fitted_ref_serves_slot_sized_png():
+    buf = BytesIO()
+    Image.new('RGB', (2400, 3200), 'green').save(buf, format='JPEG')
+
+    registry = AssetRegistry()
+    ref = registry.put_bytes(buf.getvalue())
+    fitted = registry.fitted_ref(ref, 300, 400, 'slice', (0.5, 0.5))
+    assert fitted == registry.fitted_ref(ref, 300, 400, 'slice', (0.5, 0.5))
+    png = registry.url_fetcher(fitted, 'image/*')
+    assert Image.open(BytesIO(png)).size == (300, 400)
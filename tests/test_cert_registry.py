@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cert_registry import CertRegistry
+
+
+def _entry(name, cert_id='AIK22A001'):
+    return {'cert_id': cert_id, 'name': name, 'roll': '22A001', 'date': '08-02-2026'}
+
+
+def test_reissue_keeps_original_certificate(tmp_path):
+    registry = CertRegistry(str(tmp_path / 'certs.db'))
+    assert registry.issue([_entry('ALICE')], run_id='run-1') == 1
+    assert registry.issue([_entry('ALICE')], run_id='run-2') == 0  # resumed run: no-op
+    assert registry.issue([_entry('MALLORY')], run_id='run-3') == 0  # forged name: refused
+
+    entry, _ = CertRegistry(str(tmp_path / 'certs.db')).lookup('AIK22A001')
+    assert (entry['name'], entry['run_id']) == ('ALICE', 'run-1')
@@ -0,0 +1,54 @@
+import itertools
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smart_ingestion import PhotoIndex, SmartIngestor
+
+
+PHOTOS = [
+    '22A001.jpg', '22A0012.jpg', 'old_22a001_v2.png', '22A010.jpeg', 'A1.webp',
+    '22B500.jpg',  # empty file: a roll hit on it falls through to the name
+    'ravi_kumar.jpg', 'RAVI-KUMAR-2.jpg', 'ravikumarr.png', 'priya.s.jpg', "o'neil.jpg",
+    'SITA.jpg',  # empty file: never a name hit
+]
+ROLLS = ['22A001', '22A01', '22A0', '22A099', 'A1', '1', '22B500', 'ZZ9', 'N/A']
+NAMES = ['Ravi Kumar', 'Ravi Kumaar', 'RAVI', 'Ali', 'Priya S', "O'Neil", 'Sita', 'Unknown']
+
+
+def _raw_photos(order):
+    return {fname: (b'' if fname in ('22B500.jpg', 'SITA.jpg') else fname.encode()) for fname in order}
+
+
+def _linear_scan(raw_photos, roll, name):
+    """The per-row scan PhotoIndex replaced."""
+    photo_bytes = None
+    if roll != 'N/A':
+        for fname, pbytes in raw_photos.items():
+            base = os.path.splitext(fname)[0].upper()
+            if roll in base:
+                photo_bytes = pbytes
+                break
+    if not photo_bytes:
+        for fname, pbytes in raw_photos.items():
+            if not pbytes: continue
+            clean_fname = re.sub(r'[^A-Z0-9]', '', os.path.splitext(fname)[0].upper())
+            clean_name = re.sub(r'[^A-Z0-9]', '', name)
+            if clean_name and clean_name in clean_fname and len(clean_name) > 3:
+                photo_bytes = pbytes
+                break
+    return photo_bytes or None
+
+
+def test_index_picks_the_same_photo_as_linear_scan():
+    ingestor = SmartIngestor()
+    ingestor._normalize_photo = lambda data: data
+    for order in (PHOTOS, PHOTOS[::-1]):
+        raw_photos = _raw_photos(order)
+        index = PhotoIndex(raw_photos)
+        for roll, name in itertools.product(ROLLS, NAMES):
+            expected = _linear_scan(raw_photos, roll, name.upper())
+            result = ingestor._process_single_row({'roll': roll, 'name': name}, index)
+            assert (result[1] if result else None) == expected, (order[0], roll, name)
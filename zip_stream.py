@@ -0,0 +1,70 @@
+"""Build a ZIP archive incrementally and yield it as it is written.
+
+Used for the certificate download: the archive is produced on the fly from
+the certificates that exist at request time, so the first bytes go out
+immediately and the archive always matches the finished set. Already
+compressed formats (PNG, JPEG, WebP, PDF) are stored rather than deflated.
+"""
+import os
+import zipfile
+
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.pdf', '.zip')
+
+
+class ChunkSink:
+    """Write-only file object that collects bytes until they are taken."""
+
+    def __init__(self):
+        self._chunks = []
+        self.pending = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.pending += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.pending = 0
+        return data
+
+
+def iter_zip(files, chunk_size=256 * 1024):
+    """Yield a ZIP archive of ``files`` ([(path, arcname), ...]) chunk by chunk."""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as zf:
+        for path, arcname in files:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, 'rb')
+            except OSError:
+                continue  # removed since listing (e.g. run cleanup)
+            if arcname.lower().endswith(STORED_EXTENSIONS):
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with src, zf.open(zinfo, 'w') as dest:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    if sink.pending >= chunk_size:
+                        yield sink.take()
+            if sink.pending:
+                yield sink.take()
+    # Central directory
+    yield sink.take()
+
+
+def iter_zip_dir(directory, extensions=None):
+    """Yield a ZIP of the (finished) files in ``directory``, sorted by name."""
+    names = sorted(
+        f for f in os.listdir(directory)
+        if not f.startswith('.') and (extensions is None or f.lower().endswith(extensions))
+    )
+    return iter_zip((os.path.join(directory, f), f) for f in names)